@@ -18,10 +18,10 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
 SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
-    'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'pollreactor.c', 'msgblock.c', 'trdispatch.c', 'lookahead.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'kin_bed_mesh.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
@@ -84,11 +84,29 @@ defs_trapq = """
         double x_r, y_r, z_r;
     };
 
+    struct pull_position {
+        double x, y, z;
+        double velocity, accel;
+        double x_velocity, y_velocity, z_velocity;
+        double x_accel, y_accel, z_accel;
+    };
+
+    struct trapq_batch_move {
+        double is_kinematic_move;
+        double accel_t, cruise_t, decel_t;
+        double start_v, cruise_v, accel;
+        double start_pos_x, start_pos_y, start_pos_z, start_pos_e;
+        double axes_r_x, axes_r_y, axes_r_z, axes_r_e;
+    };
+
     void trapq_append(struct trapq *tq, double print_time
         , double accel_t, double cruise_t, double decel_t
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq, struct trapq *etq
+        , double print_time, double pressure_advance
+        , struct trapq_batch_move *moves, int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_finalize_moves(struct trapq *tq, double print_time);
@@ -96,6 +114,20 @@ defs_trapq = """
         , double pos_x, double pos_y, double pos_z);
     int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
         , double start_time, double end_time);
+    int trapq_sample_moves(struct pull_move *moves, int move_count
+        , double *times, struct pull_position *out, int count);
+"""
+
+defs_lookahead = """
+    struct lookahead_move {
+        double move_d, accel;
+        double max_start_v2, max_cruise_v2, delta_v2;
+        double max_smoothed_v2, smooth_delta_v2;
+        double start_v, cruise_v, end_v;
+        double accel_t, cruise_t, decel_t;
+    };
+
+    int lookahead_flush(struct lookahead_move *moves, int count, int lazy);
 """
 
 defs_kin_cartesian = """
@@ -147,6 +179,18 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_kin_bed_mesh = """
+    int bed_mesh_set_params(struct bed_mesh *bm, int x_count, int y_count
+        , double min_x, double min_y, double x_dist, double y_dist
+        , double x_offset, double y_offset, double fade_start
+        , double fade_end, double fade_target, double *matrix);
+    struct bed_mesh *bed_mesh_alloc(void);
+    void bed_mesh_free(struct bed_mesh *bm);
+    int mesh_stepper_set_sk(struct stepper_kinematics *sk
+        , struct stepper_kinematics *orig_sk);
+    struct stepper_kinematics *mesh_stepper_alloc(struct bed_mesh *bm);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -165,8 +209,15 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    int serialqueue_send_params(struct serialqueue *sq
+        , struct command_queue *cq, const char *types, uint32_t msgid
+        , int64_t *ints, uint8_t *bufs, uint64_t min_clock
+        , uint64_t req_clock, uint64_t notify_id);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_get_receive_fd(struct serialqueue *sq);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -178,6 +229,16 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgblock = """
+    #define MSGBLOCK_MAX_MSGID 128
+    int msgblock_encode_msg(uint8_t *out, const char *types, uint32_t msgid
+        , int64_t *ints, uint8_t *bufs);
+    int msgblock_parse_msg(const char *types, uint8_t *msg, int pos
+        , int msg_len, int64_t *vals);
+    int msgblock_parse_batch(char **formats
+        , struct pull_queue_message *msgs, int count, int64_t *vals);
+"""
+
 defs_trdispatch = """
     void trdispatch_start(struct trdispatch *td, uint32_t dispatch_reason);
     void trdispatch_stop(struct trdispatch *td);
@@ -201,11 +262,11 @@ defs_std = """
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_trdispatch,
-    defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
-    defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch, defs_kin_extruder,
-    defs_kin_shaper,
+    defs_pyhelper, defs_serialqueue, defs_msgblock, defs_std,
+    defs_stepcompress, defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_lookahead, defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz,
+    defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
+    defs_kin_extruder, defs_kin_shaper, defs_kin_bed_mesh,
 ]
 
 # Update filenames to an absolute path
@@ -0,0 +1,236 @@
+// Bed mesh z adjustment during stepper step generation
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // floor, fmin, fmax
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // struct stepper_kinematics
+#include "trapq.h" // move_get_coord
+
+
+/****************************************************************
+ * Mesh lookup
+ ****************************************************************/
+
+struct bed_mesh {
+    int x_count, y_count;
+    double min_x, min_y, x_dist, y_dist, x_offset, y_offset;
+    double fade_start, fade_end, fade_target;
+    double *matrix;
+    int generation;
+};
+
+static inline double
+lerp(double t, double v0, double v1)
+{
+    return (1. - t) * v0 + t * v1;
+}
+
+// Find the mesh cell (and position within it) for a coordinate
+static inline int
+get_linear_index(double coord, double mesh_min, double mesh_dist, int count
+                 , double *t)
+{
+    int idx = floor((coord - mesh_min) / mesh_dist);
+    if (idx < 0)
+        idx = 0;
+    else if (idx > count - 2)
+        idx = count - 2;
+    double tc = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist;
+    *t = tc < 0. ? 0. : (tc > 1. ? 1. : tc);
+    return idx;
+}
+
+// Bilinear interpolation of the mesh at the given xy position
+static double
+bed_mesh_calc_z(struct bed_mesh *bm, double x, double y)
+{
+    double tx, ty;
+    int xidx = get_linear_index(x + bm->x_offset, bm->min_x, bm->x_dist
+                                , bm->x_count, &tx);
+    int yidx = get_linear_index(y + bm->y_offset, bm->min_y, bm->y_dist
+                                , bm->y_count, &ty);
+    double *row0 = &bm->matrix[yidx * bm->x_count + xidx];
+    double *row1 = row0 + bm->x_count;
+    double z0 = lerp(tx, row0[0], row0[1]);
+    double z1 = lerp(tx, row1[0], row1[1]);
+    return lerp(ty, z0, z1);
+}
+
+// Return the total z adjustment (including fade) at a g-code position
+static double
+bed_mesh_calc_adjust(struct bed_mesh *bm, double x, double y, double z)
+{
+    double factor = 1.;
+    if (z >= bm->fade_end)
+        factor = 0.;
+    else if (z >= bm->fade_start)
+        factor = (bm->fade_end - z) / (bm->fade_end - bm->fade_start);
+    double offset = bm->fade_target;
+    return factor * (bed_mesh_calc_z(bm, x, y) - offset) + offset;
+}
+
+// Return the total z adjustment at a toolhead position (one that
+// already includes the adjustment) - this matches the calculation in
+// BedMesh.get_position() in bed_mesh.py
+static double
+bed_mesh_calc_toolhead_adjust(struct bed_mesh *bm, double x, double y
+                              , double z)
+{
+    double max_adj = bed_mesh_calc_z(bm, x, y);
+    double z_adj = max_adj - bm->fade_target, factor = 1.;
+    if (fmin(z, z - max_adj) >= bm->fade_end) {
+        factor = 0.;
+    } else if (fmax(z, z - max_adj) >= bm->fade_start) {
+        factor = ((bm->fade_end + bm->fade_target - z)
+                  / (bm->fade_end - bm->fade_start - z_adj));
+        factor = fmin(fmax(factor, 0.), 1.);
+    }
+    return factor * z_adj + bm->fade_target;
+}
+
+int __visible
+bed_mesh_set_params(struct bed_mesh *bm, int x_count, int y_count
+                    , double min_x, double min_y, double x_dist, double y_dist
+                    , double x_offset, double y_offset, double fade_start
+                    , double fade_end, double fade_target, double *matrix)
+{
+    free(bm->matrix);
+    bm->matrix = NULL;
+    bm->x_count = bm->y_count = 0;
+    bm->generation++;
+    if (x_count < 2 || y_count < 2)
+        return 0;
+    int size = x_count * y_count * sizeof(*matrix);
+    bm->matrix = malloc(size);
+    if (!bm->matrix)
+        return -1;
+    memcpy(bm->matrix, matrix, size);
+    bm->x_count = x_count;
+    bm->y_count = y_count;
+    bm->min_x = min_x;
+    bm->min_y = min_y;
+    bm->x_dist = x_dist;
+    bm->y_dist = y_dist;
+    bm->x_offset = x_offset;
+    bm->y_offset = y_offset;
+    bm->fade_start = fade_start;
+    bm->fade_end = fade_end;
+    bm->fade_target = fade_target;
+    return 0;
+}
+
+struct bed_mesh * __visible
+bed_mesh_alloc(void)
+{
+    struct bed_mesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    return bm;
+}
+
+void __visible
+bed_mesh_free(struct bed_mesh *bm)
+{
+    free(bm->matrix);
+    free(bm);
+}
+
+
+/****************************************************************
+ * Kinematics-related mesh code
+ ****************************************************************/
+
+// The host code adjusts the z position at the start and end of each
+// move to match the mesh, so only the deviation of the mesh from a
+// straight line between those points needs to be added here.  The
+// deviation is calculated over the full move (not the individual
+// accel, cruise, and decel segments that trapq_append() queues), and
+// the fade factor is calculated from the g-code z (the toolhead z
+// without the mesh adjustment) as the host code does.
+
+#define DUMMY_T 500.0
+
+struct mesh_stepper {
+    struct stepper_kinematics sk;
+    struct stepper_kinematics *orig_sk;
+    struct bed_mesh *bm;
+    struct move m;
+    // Adjustments at the start and end of the full move of the last
+    // move segment processed
+    double cache_print_time, cache_start_d;
+    int cache_generation;
+    double start_z, end_z, start_adj, end_adj;
+};
+
+static void
+mesh_update_cache(struct mesh_stepper *ms, struct move *m)
+{
+    struct bed_mesh *bm = ms->bm;
+    double start_d = m->full_start_d, move_d = m->full_move_d;
+    double sx = m->start_pos.x - m->axes_r.x * start_d;
+    double sy = m->start_pos.y - m->axes_r.y * start_d;
+    double sz = m->start_pos.z - m->axes_r.z * start_d;
+    double ex = sx + m->axes_r.x * move_d;
+    double ey = sy + m->axes_r.y * move_d;
+    double ez = sz + m->axes_r.z * move_d;
+    ms->start_adj = bed_mesh_calc_toolhead_adjust(bm, sx, sy, sz);
+    ms->end_adj = bed_mesh_calc_toolhead_adjust(bm, ex, ey, ez);
+    ms->start_z = sz - ms->start_adj;
+    ms->end_z = ez - ms->end_adj;
+    ms->cache_print_time = m->print_time;
+    ms->cache_start_d = start_d;
+    ms->cache_generation = bm->generation;
+}
+
+static double
+mesh_calc_position(struct stepper_kinematics *sk, struct move *m
+                   , double move_time)
+{
+    struct mesh_stepper *ms = container_of(sk, struct mesh_stepper, sk);
+    struct bed_mesh *bm = ms->bm;
+    double move_d = m->full_move_d;
+    if (!bm->x_count || !move_d || (!m->axes_r.x && !m->axes_r.y))
+        return ms->orig_sk->calc_position_cb(ms->orig_sk, m, move_time);
+    if (m->print_time != ms->cache_print_time
+        || m->full_start_d != ms->cache_start_d
+        || bm->generation != ms->cache_generation)
+        mesh_update_cache(ms, m);
+    double s = (m->full_start_d + move_get_distance(m, move_time)) / move_d;
+    struct coord c = move_get_coord(m, move_time);
+    double gcode_z = lerp(s, ms->start_z, ms->end_z);
+    c.z += (bed_mesh_calc_adjust(bm, c.x, c.y, gcode_z)
+            - lerp(s, ms->start_adj, ms->end_adj));
+    ms->m.start_pos = c;
+    return ms->orig_sk->calc_position_cb(ms->orig_sk, &ms->m, DUMMY_T);
+}
+
+int __visible
+mesh_stepper_set_sk(struct stepper_kinematics *sk
+                    , struct stepper_kinematics *orig_sk)
+{
+    // Only steppers that solely depend on the z axis are supported
+    if (orig_sk->active_flags != AF_Z)
+        return -1;
+    struct mesh_stepper *ms = container_of(sk, struct mesh_stepper, sk);
+    ms->sk.active_flags = AF_X | AF_Y | AF_Z;
+    ms->sk.gen_steps_pre_active = orig_sk->gen_steps_pre_active;
+    ms->sk.gen_steps_post_active = orig_sk->gen_steps_post_active;
+    ms->orig_sk = orig_sk;
+    return 0;
+}
+
+struct stepper_kinematics * __visible
+mesh_stepper_alloc(struct bed_mesh *bm)
+{
+    struct mesh_stepper *ms = malloc(sizeof(*ms));
+    memset(ms, 0, sizeof(*ms));
+    ms->sk.calc_position_cb = mesh_calc_position;
+    ms->bm = bm;
+    ms->m.move_t = 2. * DUMMY_T;
+    return &ms->sk;
+}
@@ -0,0 +1,115 @@
+// Toolhead move queue "look-ahead" junction velocity planning
+//
+// Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // sqrt
+#include "compiler.h" // __visible
+
+// Lookahead parameters of a single queued move.  The python code
+// fills the first fields (all velocities are tracked in velocity
+// squared) and lookahead_flush() fills in the remaining fields.
+struct lookahead_move {
+    double move_d, accel;
+    double max_start_v2, max_cruise_v2, delta_v2;
+    double max_smoothed_v2, smooth_delta_v2;
+    double start_v, cruise_v, end_v;
+    double accel_t, cruise_t, decel_t;
+};
+
+// Determine accel, cruise, and decel portions of the move
+static void
+set_junction(struct lookahead_move *m, double start_v2, double cruise_v2
+             , double end_v2)
+{
+    double half_inv_accel = .5 / m->accel;
+    double accel_d = (cruise_v2 - start_v2) * half_inv_accel;
+    double decel_d = (cruise_v2 - end_v2) * half_inv_accel;
+    double cruise_d = m->move_d - accel_d - decel_d;
+    // Determine move velocities
+    double start_v = sqrt(start_v2), cruise_v = sqrt(cruise_v2);
+    double end_v = sqrt(end_v2);
+    m->start_v = start_v;
+    m->cruise_v = cruise_v;
+    m->end_v = end_v;
+    // Determine time spent in each portion of move (time is the
+    // distance divided by average velocity)
+    m->accel_t = accel_d / ((start_v + cruise_v) * 0.5);
+    m->cruise_t = cruise_d / cruise_v;
+    m->decel_t = decel_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Traverse queue from last to first move and determine maximum
+// junction speed assuming the robot comes to a complete stop after
+// the last move.  Returns the number of moves (from the start of the
+// queue) that are ready to be flushed - the velocities and timing of
+// those moves are filled in.
+int __visible
+lookahead_flush(struct lookahead_move *moves, int count, int lazy)
+{
+    int update_flush_count = lazy, flush_count = count;
+    // Moves that can not accelerate are "delayed" until peak_cruise_v2
+    // is known.  Delayed moves are always the contiguous range
+    // starting just after the current move.  While delayed, the
+    // move's start_v and end_v fields hold its start_v2 and end_v2.
+    int delayed = 0;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    int i;
+    for (i = count - 1; i >= 0; i--) {
+        struct lookahead_move *move = &moves[i];
+        double reachable_start_v2 = next_end_v2 + move->delta_v2;
+        double start_v2 = fmin(move->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = (next_smoothed_v2
+                                        + move->smooth_delta_v2);
+        double smoothed_v2 = fmin(move->max_smoothed_v2
+                                  , reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + move->smooth_delta_v2 > next_smoothed_v2
+                || delayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = fmin(move->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        int j;
+                        for (j = i + 1; j <= i + delayed; j++) {
+                            struct lookahead_move *m = &moves[j];
+                            double ms_v2 = m->start_v, me_v2 = m->end_v;
+                            mc_v2 = fmin(mc_v2, ms_v2);
+                            set_junction(m, fmin(ms_v2, mc_v2), mc_v2
+                                         , fmin(me_v2, mc_v2));
+                        }
+                    }
+                    delayed = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = fmin(fmin(
+                    (start_v2 + reachable_start_v2) * .5
+                    , move->max_cruise_v2), peak_cruise_v2);
+                set_junction(move, fmin(start_v2, cruise_v2), cruise_v2
+                             , fmin(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            move->start_v = start_v2;
+            move->end_v = next_end_v2;
+            delayed++;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
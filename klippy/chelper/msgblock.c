@@ -7,6 +7,7 @@
 #include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
+#include "compiler.h" // __visible
 #include "msgblock.h" // message_alloc
 #include "pyhelper.h" // errorf
 
@@ -119,6 +120,140 @@ msgblock_decode(uint32_t *data, int data_len, uint8_t *msg, int msg_len)
 }
 
 
+/****************************************************************
+ * Message parameter encoding and parsing
+ ****************************************************************/
+
+// Parameter types in the 'types' string of msgblock_encode_msg()
+// and msgblock_parse_msg()
+#define MPT_UINT 'u'
+#define MPT_INT 'i'
+#define MPT_BUFFER 's'
+
+// Encode an integer as a "variable length quantity" (using the same
+// encoding as the python code for values outside the int32 range)
+static uint8_t *
+encode_int64(uint8_t *p, int64_t v)
+{
+    if (v >= 0xc000000 || v < -0x4000000)
+        *p++ = ((v>>28) & 0x7f) | 0x80;
+    if (v >= 0x180000 || v < -0x80000)
+        *p++ = ((v>>21) & 0x7f) | 0x80;
+    if (v >= 0x3000 || v < -0x1000)
+        *p++ = ((v>>14) & 0x7f) | 0x80;
+    if (v >= 0x60 || v < -0x20)
+        *p++ = ((v>>7) & 0x7f) | 0x80;
+    *p++ = v & 0x7f;
+    return p;
+}
+
+// Encode a message using the given parameter types.  Integer
+// parameters are read from 'ints'.  Buffer parameters store their
+// length in 'ints' and their contents are concatenated in 'bufs'.
+// Returns the length of the encoded message or -1 on error.
+int __visible
+msgblock_encode_msg(uint8_t *out, const char *types, uint32_t msgid
+                    , int64_t *ints, uint8_t *bufs)
+{
+    uint8_t *p = out, *end = &out[MESSAGE_PAYLOAD_MAX];
+    *p++ = msgid;
+    for (; *types; types++) {
+        if (*types == MPT_BUFFER) {
+            int64_t len = *ints++;
+            if (len < 0 || len > end - p - 1)
+                return -1;
+            *p++ = len;
+            memcpy(p, bufs, len);
+            p += len;
+            bufs += len;
+        } else {
+            p = encode_int64(p, *ints++);
+            if (p > end)
+                return -1;
+        }
+    }
+    return p - out;
+}
+
+// Parse an integer that was encoded as a "variable length quantity"
+// (sign extending it in the same way as the python code)
+static int64_t
+parse_int64(uint8_t **pp)
+{
+    uint8_t *p = *pp, c = *p++;
+    uint64_t v = c & 0x7f;
+    if ((c & 0x60) == 0x60)
+        v |= -0x20;
+    while (c & 0x80) {
+        c = *p++;
+        v = (v<<7) | (c & 0x7f);
+    }
+    *pp = p;
+    return v;
+}
+
+// Parse the parameters of the message starting at 'pos' using the
+// given parameter types.  Integer parameters are stored in 'vals'.
+// Buffer parameters store the offset of their contents in 'vals'
+// (the buffer length is in the preceding byte).  Returns the offset
+// following the last parameter or -1 on error.
+int __visible
+msgblock_parse_msg(const char *types, uint8_t *msg, int pos, int msg_len
+                   , int64_t *vals)
+{
+    uint8_t *p = &msg[pos + 1], *end = &msg[msg_len - MESSAGE_TRAILER_SIZE];
+    for (; *types; types++) {
+        if (p >= end)
+            return -1;
+        if (*types == MPT_BUFFER) {
+            int len = *p++;
+            *vals++ = p - msg;
+            p += len;
+            if (p > end)
+                return -1;
+        } else {
+            int64_t v = parse_int64(&p);
+            if (*types == MPT_UINT)
+                v &= 0xffffffff;
+            *vals++ = v;
+        }
+    }
+    return p - msg;
+}
+
+// Parse a batch of received messages.  The 'formats' array contains
+// the parameter types of each known msgid.  For each message the
+// msgid is stored in 'vals' (or -1 if the message could not be
+// parsed) followed by the message parameters.  The 'vals' array must
+// have room for 'count * (MESSAGE_PAYLOAD_MAX + 1)' entries.
+// Returns the number of entries stored in 'vals'.
+int __visible
+msgblock_parse_batch(char **formats, struct pull_queue_message *msgs
+                     , int count, int64_t *vals)
+{
+    int64_t *v = vals;
+    int i;
+    for (i=0; i<count; i++) {
+        struct pull_queue_message *pqm = &msgs[i];
+        int64_t *msgidp = v++;
+        *msgidp = -1;
+        if (pqm->len <= MESSAGE_MIN)
+            continue;
+        uint8_t msgid = pqm->msg[MESSAGE_HEADER_SIZE];
+        char *types = msgid < MSGBLOCK_MAX_MSGID ? formats[msgid] : NULL;
+        if (!types)
+            continue;
+        int pos = msgblock_parse_msg(types, pqm->msg, MESSAGE_HEADER_SIZE
+                                     , pqm->len, v);
+        if (pos != pqm->len - MESSAGE_TRAILER_SIZE)
+            continue;
+        *msgidp = msgid;
+        v += strlen(types);
+    }
+    return v - vals;
+}
+
+
 /****************************************************************
  * Command queues
  ****************************************************************/
@@ -16,6 +16,7 @@
 #define MESSAGE_SEQ_MASK 0x0f
 #define MESSAGE_DEST 0x10
 #define MESSAGE_SYNC 0x7E
+#define MSGBLOCK_MAX_MSGID 128
 
 struct queue_message {
     int len;
@@ -34,6 +35,13 @@ struct queue_message {
     struct list_node node;
 };
 
+struct pull_queue_message {
+    uint8_t msg[MESSAGE_MAX];
+    int len;
+    double sent_time, receive_time;
+    uint64_t notify_id;
+};
+
 struct clock_estimate {
     uint64_t last_clock, conv_clock;
     double conv_time, est_freq;
@@ -42,6 +50,12 @@ struct clock_estimate {
 uint16_t msgblock_crc16_ccitt(uint8_t *buf, uint8_t len);
 int msgblock_check(uint8_t *need_sync, uint8_t *buf, int buf_len);
 int msgblock_decode(uint32_t *data, int data_len, uint8_t *msg, int msg_len);
+int msgblock_encode_msg(uint8_t *out, const char *types, uint32_t msgid
+                        , int64_t *ints, uint8_t *bufs);
+int msgblock_parse_msg(const char *types, uint8_t *msg, int pos, int msg_len
+                       , int64_t *vals);
+int msgblock_parse_batch(char **formats, struct pull_queue_message *msgs
+                         , int count, int64_t *vals);
 struct queue_message *message_alloc(void);
 struct queue_message *message_fill(uint8_t *data, int len);
 struct queue_message *message_alloc_and_encode(uint32_t *data, int len);
@@ -46,7 +46,8 @@ struct serialqueue {
     pthread_t tid;
     pthread_mutex_t lock; // protects variables below
     pthread_cond_t cond;
-    int receive_waiting;
+    int receive_waiting, receive_notified;
+    int receive_pipe_fds[2];
     // Baud / clock tracking
     int receive_window;
     double baud_adjust, idle_time;
@@ -62,7 +63,9 @@ struct serialqueue {
     int ready_bytes, stalled_bytes, need_ack_bytes, last_ack_bytes;
     uint64_t need_kick_clock;
     struct list_head notify_queue;
-    // Received messages
+    // Received messages (ring buffer with an overflow list)
+    struct pull_queue_message *receive_ring;
+    unsigned int receive_head, receive_tail;
     struct list_head receive_queue;
     // Fastreader support
     pthread_mutex_t fast_reader_dispatch_lock;
@@ -95,6 +98,8 @@ struct serialqueue {
 #define DEBUG_QUEUE_SENT 100
 #define DEBUG_QUEUE_RECEIVE 100
 
+#define RECEIVE_RING_SIZE 512
+
 // Create a series of empty messages and add them to a list
 static void
 debug_queue_alloc(struct list_head *root, int count)
@@ -127,6 +132,88 @@ check_wake_receive(struct serialqueue *sq)
     }
 }
 
+// Add a received message (or completed notification) to the receive
+// queue and wake any readers
+static void
+receive_queue_add(struct serialqueue *sq, uint8_t *msg, int len
+                  , double sent_time, double receive_time, uint64_t notify_id)
+{
+    if (list_empty(&sq->receive_queue)
+        && sq->receive_head - sq->receive_tail < RECEIVE_RING_SIZE) {
+        // Store directly in the ring buffer
+        struct pull_queue_message *pqm = &sq->receive_ring[
+            sq->receive_head++ % RECEIVE_RING_SIZE];
+        memcpy(pqm->msg, msg, len);
+        pqm->len = len;
+        pqm->sent_time = sent_time;
+        pqm->receive_time = receive_time;
+        pqm->notify_id = notify_id;
+    } else {
+        // Ring buffer full - store on overflow list
+        struct queue_message *qm = message_fill(msg, len);
+        qm->sent_time = sent_time;
+        qm->receive_time = receive_time;
+        qm->notify_id = notify_id;
+        list_add_tail(&qm->node, &sq->receive_queue);
+    }
+    if (!sq->receive_notified) {
+        // Only signal the receive pipe when the queue was empty
+        sq->receive_notified = 1;
+        int ret = write(sq->receive_pipe_fds[1], ".", 1);
+        if (ret < 0)
+            report_errno("pipe write", ret);
+    }
+    check_wake_receive(sq);
+}
+
+// Move up to 'max' messages from the receive queue to 'q'
+static int
+receive_queue_pull(struct serialqueue *sq, struct pull_queue_message *q
+                   , int max)
+{
+    int count = 0;
+    while (count < max) {
+        struct pull_queue_message *pqm = &q[count];
+        if (sq->receive_head != sq->receive_tail) {
+            memcpy(pqm, &sq->receive_ring[sq->receive_tail++
+                                          % RECEIVE_RING_SIZE], sizeof(*pqm));
+        } else if (!list_empty(&sq->receive_queue)) {
+            struct queue_message *qm = list_first_entry(
+                &sq->receive_queue, struct queue_message, node);
+            list_del(&qm->node);
+            memcpy(pqm->msg, qm->msg, qm->len);
+            pqm->len = qm->len;
+            pqm->sent_time = qm->sent_time;
+            pqm->receive_time = qm->receive_time;
+            pqm->notify_id = qm->notify_id;
+            message_free(qm);
+        } else {
+            break;
+        }
+        count++;
+        if (!pqm->len)
+            continue;
+        // Copy data message to debug queue (reusing oldest debug entry)
+        struct queue_message *old = list_first_entry(
+            &sq->old_receive, struct queue_message, node);
+        list_del(&old->node);
+        memcpy(old->msg, pqm->msg, pqm->len);
+        old->len = pqm->len;
+        old->sent_time = pqm->sent_time;
+        old->receive_time = pqm->receive_time;
+        list_add_tail(&old->node, &sq->old_receive);
+    }
+    return count;
+}
+
+// Check if there are no messages on the receive queue
+static int
+receive_queue_empty(struct serialqueue *sq)
+{
+    return (sq->receive_head == sq->receive_tail
+            && list_empty(&sq->receive_queue));
+}
+
 // Write to the internal pipe to wake the background thread if in poll
 static void
 kick_bg_thread(struct serialqueue *sq)
@@ -221,7 +308,6 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     sq->bytes_read += len;
 
     // Check for pending messages on notify_queue
-    int must_wake = 0;
     while (!list_empty(&sq->notify_queue)) {
         struct queue_message *qm = list_first_entry(
             &sq->notify_queue, struct queue_message, node);
@@ -230,11 +316,9 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
         if (notify_msg_sent_seq > wake_seq)
             break;
         list_del(&qm->node);
-        qm->len = 0;
-        qm->sent_time = sq->last_receive_sent_time;
-        qm->receive_time = eventtime;
-        list_add_tail(&qm->node, &sq->receive_queue);
-        must_wake = 1;
+        receive_queue_add(sq, sq->input_buf, 0, sq->last_receive_sent_time
+                          , eventtime, qm->notify_id);
+        message_free(qm);
     }
 
     // Process message
@@ -247,13 +331,11 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
             pollreactor_update_timer(sq->pr, SQPT_RETRANSMIT, PR_NOW);
     } else {
         // Data message - add to receive queue
-        struct queue_message *qm = message_fill(sq->input_buf, len);
-        qm->sent_time = (rseq > sq->retransmit_seq
-                         ? sq->last_receive_sent_time : 0.);
-        qm->receive_time = get_monotonic(); // must be time post read()
-        qm->receive_time -= sq->baud_adjust * len;
-        list_add_tail(&qm->node, &sq->receive_queue);
-        must_wake = 1;
+        double sent_time = (rseq > sq->retransmit_seq
+                            ? sq->last_receive_sent_time : 0.);
+        double receive_time = get_monotonic(); // must be time post read()
+        receive_time -= sq->baud_adjust * len;
+        receive_queue_add(sq, sq->input_buf, len, sent_time, receive_time, 0);
     }
 
     // Check fast readers
@@ -265,16 +347,12 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
             continue;
         // Release main lock and invoke callback
         pthread_mutex_lock(&sq->fast_reader_dispatch_lock);
-        if (must_wake)
-            check_wake_receive(sq);
         pthread_mutex_unlock(&sq->lock);
         fr->func(fr, sq->input_buf, len);
         pthread_mutex_unlock(&sq->fast_reader_dispatch_lock);
         return;
     }
 
-    if (must_wake)
-        check_wake_receive(sq);
     pthread_mutex_unlock(&sq->lock);
 }
 
@@ -603,6 +681,9 @@ serialqueue_alloc(int serial_fd, char serial_fd_type, int client_id)
     sq->client_id = client_id;
 
     int ret = pipe(sq->pipe_fds);
+    if (ret)
+        goto fail;
+    ret = pipe(sq->receive_pipe_fds);
     if (ret)
         goto fail;
 
@@ -616,6 +697,8 @@ serialqueue_alloc(int serial_fd, char serial_fd_type, int client_id)
     fd_set_non_blocking(serial_fd);
     fd_set_non_blocking(sq->pipe_fds[0]);
     fd_set_non_blocking(sq->pipe_fds[1]);
+    fd_set_non_blocking(sq->receive_pipe_fds[0]);
+    fd_set_non_blocking(sq->receive_pipe_fds[1]);
 
     // Retransmit setup
     sq->send_seq = 1;
@@ -632,6 +715,7 @@ serialqueue_alloc(int serial_fd, char serial_fd_type, int client_id)
     sq->need_kick_clock = MAX_CLOCK;
     list_init(&sq->pending_queues);
     list_init(&sq->sent_queue);
+    sq->receive_ring = malloc(RECEIVE_RING_SIZE * sizeof(*sq->receive_ring));
     list_init(&sq->receive_queue);
     list_init(&sq->notify_queue);
     list_init(&sq->fast_readers);
@@ -697,6 +781,11 @@ serialqueue_free(struct serialqueue *sq)
     }
     pthread_mutex_unlock(&sq->lock);
     pollreactor_free(sq->pr);
+    close(sq->pipe_fds[0]);
+    close(sq->pipe_fds[1]);
+    close(sq->receive_pipe_fds[0]);
+    close(sq->receive_pipe_fds[1]);
+    free(sq->receive_ring);
     free(sq);
 }
 
@@ -806,6 +895,28 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_one(sq, cq, qm);
 }
 
+// Encode a message using the given parameter types (see
+// msgblock_encode_msg) and schedule it for transmission
+int __visible
+serialqueue_send_params(struct serialqueue *sq, struct command_queue *cq
+                        , const char *types, uint32_t msgid, int64_t *ints
+                        , uint8_t *bufs, uint64_t min_clock
+                        , uint64_t req_clock, uint64_t notify_id)
+{
+    struct queue_message *qm = message_alloc();
+    int len = msgblock_encode_msg(qm->msg, types, msgid, ints, bufs);
+    if (len < 0) {
+        message_free(qm);
+        return -1;
+    }
+    qm->len = len;
+    qm->min_clock = min_clock;
+    qm->req_clock = req_clock;
+    qm->notify_id = notify_id;
+    serialqueue_send_one(sq, cq, qm);
+    return 0;
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
 void __visible
@@ -813,7 +924,7 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
-    while (list_empty(&sq->receive_queue)) {
+    while (receive_queue_empty(sq)) {
         if (pollreactor_is_exit(sq->pr))
             goto exit;
         sq->receive_waiting = 1;
@@ -823,20 +934,7 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
     }
 
     // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
-
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    pqm->notify_id = qm->notify_id;
-    if (qm->len)
-        debug_queue_add(&sq->old_receive, qm);
-    else
-        message_free(qm);
+    receive_queue_pull(sq, pqm, 1);
 
     pthread_mutex_unlock(&sq->lock);
     return;
@@ -846,6 +944,28 @@ exit:
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Return the file descriptor that becomes readable when messages are
+// available via serialqueue_pull_batch()
+int __visible
+serialqueue_get_receive_fd(struct serialqueue *sq)
+{
+    return sq->receive_pipe_fds[0];
+}
+
+// Copy up to 'max' received messages into 'q' without waiting.  The
+// receive fd is signaled again only after a call that empties the queue.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    int count = receive_queue_pull(sq, q, max);
+    if (receive_queue_empty(sq))
+        sq->receive_notified = 0;
+    pthread_mutex_unlock(&sq->lock);
+    return count;
+}
+
 void __visible
 serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust)
 {
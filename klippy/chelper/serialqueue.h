@@ -18,13 +18,6 @@ struct fastreader {
     uint8_t prefix[MESSAGE_MAX];
 };
 
-struct pull_queue_message {
-    uint8_t msg[MESSAGE_MAX];
-    int len;
-    double sent_time, receive_time;
-    uint64_t notify_id;
-};
-
 struct serialqueue;
 struct serialqueue *serialqueue_alloc(int serial_fd, char serial_fd_type
                                       , int client_id);
@@ -41,7 +34,14 @@ void serialqueue_send_one(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
+int serialqueue_send_params(struct serialqueue *sq, struct command_queue *cq
+                            , const char *types, uint32_t msgid, int64_t *ints
+                            , uint8_t *bufs, uint64_t min_clock
+                            , uint64_t req_clock, uint64_t notify_id);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+int serialqueue_get_receive_fd(struct serialqueue *sq);
+int serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                           , int max);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
@@ -30,6 +30,10 @@ trapq_append(struct trapq *tq, double print_time
 {
     struct coord start_pos = { .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
     struct coord axes_r = { .x=axes_r_x, .y=axes_r_y, .z=axes_r_z };
+    double accel_d = (start_v + .5 * accel * accel_t) * accel_t;
+    double cruise_d = cruise_v * cruise_t;
+    double decel_d = (cruise_v - .5 * accel * decel_t) * decel_t;
+    double move_d = accel_d + cruise_d + decel_d;
     if (accel_t) {
         struct move *m = move_alloc();
         m->print_time = print_time;
@@ -38,6 +42,7 @@ trapq_append(struct trapq *tq, double print_time
         m->half_accel = .5 * accel;
         m->start_pos = start_pos;
         m->axes_r = axes_r;
+        m->full_move_d = move_d;
         trapq_add_move(tq, m);
 
         print_time += accel_t;
@@ -51,6 +56,8 @@ trapq_append(struct trapq *tq, double print_time
         m->half_accel = 0.;
         m->start_pos = start_pos;
         m->axes_r = axes_r;
+        m->full_start_d = accel_d;
+        m->full_move_d = move_d;
         trapq_add_move(tq, m);
 
         print_time += cruise_t;
@@ -64,10 +71,42 @@ trapq_append(struct trapq *tq, double print_time
         m->half_accel = -.5 * accel;
         m->start_pos = start_pos;
         m->axes_r = axes_r;
+        m->full_start_d = accel_d + cruise_d;
+        m->full_move_d = move_d;
         trapq_add_move(tq, m);
     }
 }
 
+// Add a batch of moves to the toolhead and extruder trapezoid queues
+void __visible
+trapq_append_batch(struct trapq *tq, struct trapq *etq, double print_time
+                   , double pressure_advance
+                   , struct trapq_batch_move *moves, int count)
+{
+    int i;
+    for (i=0; i<count; i++) {
+        struct trapq_batch_move *m = &moves[i];
+        if (m->is_kinematic_move)
+            trapq_append(tq, print_time, m->accel_t, m->cruise_t, m->decel_t
+                         , m->start_pos.x, m->start_pos.y, m->start_pos.z
+                         , m->axes_r.x, m->axes_r.y, m->axes_r.z
+                         , m->start_v, m->cruise_v, m->accel);
+        double axis_r = m->axes_r_e;
+        if (axis_r) {
+            // Queue extruder movement (x is extruder movement, y is
+            // pressure advance)
+            double pa = 0.;
+            if (axis_r > 0. && (m->axes_r.x || m->axes_r.y))
+                pa = pressure_advance;
+            trapq_append(etq, print_time, m->accel_t, m->cruise_t, m->decel_t
+                         , m->start_pos_e, 0., 0., 1., pa, 0.
+                         , m->start_v * axis_r, m->cruise_v * axis_r
+                         , m->accel * axis_r);
+        }
+        print_time = print_time + m->accel_t + m->cruise_t + m->decel_t;
+    }
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
@@ -256,3 +295,49 @@ trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
     }
     return res;
 }
+
+// Calculate the requested position, velocity, and acceleration at a
+// series of (sorted) times from an array of (sorted) moves.  The
+// velocity and acceleration are zero for times not within a move.
+// Returns the index of the move used for the last time.
+int __visible
+trapq_sample_moves(struct pull_move *moves, int move_count
+                   , double *times, struct pull_position *out, int count)
+{
+    if (!move_count) {
+        memset(out, 0, count * sizeof(*out));
+        return 0;
+    }
+    int mi = 0, i;
+    for (i=0; i<count; i++, out++) {
+        double req_time = times[i];
+        while (mi < move_count - 1
+               && req_time > moves[mi].print_time + moves[mi].move_t)
+            mi++;
+        struct pull_move *m = &moves[mi];
+        double move_time = req_time - m->print_time;
+        int in_range = move_time >= 0. && move_time <= m->move_t;
+        if (move_time < 0.)
+            move_time = 0.;
+        else if (move_time > m->move_t)
+            move_time = m->move_t;
+        double dist = (m->start_v + .5 * m->accel * move_time) * move_time;
+        out->x = m->start_x + m->x_r * dist;
+        out->y = m->start_y + m->y_r * dist;
+        out->z = m->start_z + m->z_r * dist;
+        double velocity = 0., accel = 0.;
+        if (in_range) {
+            velocity = m->start_v + m->accel * move_time;
+            accel = m->accel;
+        }
+        out->velocity = velocity;
+        out->accel = accel;
+        out->x_velocity = m->x_r * velocity;
+        out->y_velocity = m->y_r * velocity;
+        out->z_velocity = m->z_r * velocity;
+        out->x_accel = m->x_r * accel;
+        out->y_accel = m->y_r * accel;
+        out->z_accel = m->z_r * accel;
+    }
+    return mi;
+}
@@ -16,6 +16,9 @@ struct move {
     double print_time, move_t;
     double start_v, half_accel;
     struct coord start_pos, axes_r;
+    // Location of this segment within its full (accel, cruise, and
+    // decel) move as queued by trapq_append()
+    double full_start_d, full_move_d;
 
     struct list_node node;
 };
@@ -31,12 +34,32 @@ struct pull_move {
     double x_r, y_r, z_r;
 };
 
+struct pull_position {
+    double x, y, z;
+    double velocity, accel;
+    double x_velocity, y_velocity, z_velocity;
+    double x_accel, y_accel, z_accel;
+};
+
+struct trapq_batch_move {
+    double is_kinematic_move;
+    double accel_t, cruise_t, decel_t;
+    double start_v, cruise_v, accel;
+    struct coord start_pos;
+    double start_pos_e;
+    struct coord axes_r;
+    double axes_r_e;
+};
+
 struct move *move_alloc(void);
 void trapq_append(struct trapq *tq, double print_time
                   , double accel_t, double cruise_t, double decel_t
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_batch(struct trapq *tq, struct trapq *etq, double print_time
+                        , double pressure_advance
+                        , struct trapq_batch_move *moves, int count);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 struct trapq *trapq_alloc(void);
@@ -48,5 +71,7 @@ void trapq_set_position(struct trapq *tq, double print_time
                         , double pos_x, double pos_y, double pos_z);
 int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
                       , double start_time, double end_time);
+int trapq_sample_moves(struct pull_move *moves, int move_count
+                       , double *times, struct pull_position *out, int count);
 
 #endif // trapq.h
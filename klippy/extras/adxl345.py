@@ -5,6 +5,10 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
 from . import bus, motion_report
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ADXL345 registers
 REG_DEVID = 0x00
@@ -31,15 +35,35 @@ Accel_Measurement = collections.namedtuple(
 
 # Helper class to obtain measurements
 class ADXL345QueryHelper:
-    def __init__(self, printer, cconn):
+    def __init__(self, printer, api_dump, samples_cb=None):
         self.printer = printer
-        self.cconn = cconn
+        # If samples_cb is provided, the measurements are passed to it
+        # (as Nx4 numpy arrays) as they arrive instead of being stored
+        self.samples_cb = samples_cb
+        self.streamed_count = 0
+        self.is_finishing = False
+        msg_cb = None
+        if samples_cb is not None:
+            msg_cb = self._handle_message
+        self.cconn = api_dump.add_internal_client(msg_cb)
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
         self.samples = self.raw_samples = []
+    def _handle_message(self, msg):
+        samples = numpy.asarray(msg['params']['data'], dtype=float)
+        samples = samples.reshape(-1, 4)
+        times = samples[:,0]
+        valid = times >= self.request_start_time
+        if self.is_finishing:
+            valid &= times <= self.request_end_time
+        samples = samples[valid]
+        if len(samples):
+            self.streamed_count += len(samples)
+            self.samples_cb(samples)
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
+        self.is_finishing = True
         toolhead.wait_moves()
         self.cconn.finalize()
     def _get_raw_samples(self):
@@ -48,6 +72,8 @@ class ADXL345QueryHelper:
             self.raw_samples = raw_samples
         return self.raw_samples
     def has_valid_samples(self):
+        if self.samples_cb is not None:
+            return self.streamed_count > 0
         raw_samples = self._get_raw_samples()
         for msg in raw_samples:
             data = msg['params']['data']
@@ -65,10 +91,27 @@ class ADXL345QueryHelper:
             # is at least 1 second, so this possibility is negligible.
             return True
         return False
+    def get_samples_array(self):
+        # Return the measurements as an Nx4 numpy array of
+        # (time, accel_x, accel_y, accel_z) rows
+        raw_samples = self._get_raw_samples()
+        data = [m['params']['data'] for m in raw_samples]
+        data = [numpy.asarray(d, dtype=float).reshape(-1, 4)
+                for d in data if len(d)]
+        if not data:
+            return numpy.zeros((0, 4))
+        samples = numpy.concatenate(data)
+        times = samples[:,0]
+        return samples[(times >= self.request_start_time)
+                       & (times <= self.request_end_time)]
     def get_samples(self):
         raw_samples = self._get_raw_samples()
         if not raw_samples:
             return self.samples
+        if numpy is not None:
+            self.samples = [Accel_Measurement(*s)
+                            for s in self.get_samples_array().tolist()]
+            return self.samples
         total = sum([len(m['params']['data']) for m in raw_samples])
         count = 0
         self.samples = samples = [None] * total
@@ -258,7 +301,8 @@ class ADXL345:
         self.clock_sync = ClockSyncRegression(self.mcu, 640)
         # API server endpoints
         self.api_dump = motion_report.APIDumpHelper(
-            self.printer, self._api_update, self._api_startstop, 0.100)
+            self.printer, self._api_update, self._api_startstop, 0.100,
+            data_format='dfff')
         self.name = config.get_name().split()[-1]
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint("adxl345/dump_adxl345", "sensor", self.name,
@@ -294,7 +338,51 @@ class ADXL345:
     def _handle_adxl345_data(self, params):
         with self.lock:
             self.raw_samples.append(params)
+    def _extract_samples_array(self, raw_samples):
+        # Decode all messages in raw_samples into an Nx4 numpy array
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        # Determine the chip clock of the first sample in each message
+        seq = 0
+        blocks = []
+        counts = []
+        clocks = []
+        for params in raw_samples:
+            seq_diff = (last_sequence - params['sequence']) & 0xffff
+            seq_diff -= (seq_diff & 0x8000) << 1
+            seq = last_sequence - seq_diff
+            d = params['data']
+            count = len(d) // BYTES_PER_SAMPLE
+            blocks.append(d[:count * BYTES_PER_SAMPLE])
+            counts.append(count)
+            clocks.append(seq * SAMPLES_PER_BLOCK)
+        self.clock_sync.set_last_chip_clock(
+            seq * SAMPLES_PER_BLOCK + counts[-1] - 1)
+        # Decode the samples
+        np = numpy
+        d = np.frombuffer(b"".join([bytes(b) for b in blocks]), dtype=np.uint8)
+        d = d.reshape(-1, BYTES_PER_SAMPLE).astype(np.int32)
+        xlow, ylow, zlow, xzhigh, yzhigh = d.T
+        starts = np.cumsum(counts) - counts
+        cdiff = (np.arange(len(d)) + np.repeat(np.array(clocks) - starts,
+                                               counts)) - chip_base
+        valid = (yzhigh & 0x80) == 0
+        self.last_error_count += len(d) - int(np.count_nonzero(valid))
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        raw_xyz = (rx, ry, rz)
+        samples = np.empty((len(d), 4))
+        samples[:,0] = time_base + cdiff * inv_freq
+        samples[:,1] = raw_xyz[x_pos] * x_scale
+        samples[:,2] = raw_xyz[y_pos] * y_scale
+        samples[:,3] = raw_xyz[z_pos] * z_scale
+        return np.round(samples[valid], 6)
     def _extract_samples(self, raw_samples):
+        if numpy is not None:
+            return self._extract_samples_array(raw_samples)
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.last_sequence
@@ -417,7 +505,7 @@ class ADXL345:
         if not raw_samples:
             return {}
         samples = self._extract_samples(raw_samples)
-        if not samples:
+        if not len(samples):
             return {}
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.last_limit_count}
@@ -430,9 +518,8 @@ class ADXL345:
         self.api_dump.add_client(web_request)
         hdr = ('time', 'x_acceleration', 'y_acceleration', 'z_acceleration')
         web_request.send({'header': hdr})
-    def start_internal_client(self):
-        cconn = self.api_dump.add_internal_client()
-        return ADXL345QueryHelper(self.printer, cconn)
+    def start_internal_client(self, samples_cb=None):
+        return ADXL345QueryHelper(self.printer, self.api_dump, samples_cb)
 
 def load_config(config):
     return ADXL345(config)
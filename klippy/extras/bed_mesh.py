@@ -5,7 +5,12 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, json, collections
+import chelper
 from . import probe
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 PROFILE_VERSION = 1
 PROFILE_OPTIONS = {
@@ -35,6 +40,71 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# Weights of the probed points for each lagrange interpolated point
+def lagrange_weights(lpts, coords):
+    pt_cnt = len(lpts)
+    weights = []
+    for c in coords:
+        row = []
+        for i in range(pt_cnt):
+            n = d = 1.
+            for j in range(pt_cnt):
+                if j == i:
+                    continue
+                n *= (c - lpts[j])
+                d *= (lpts[i] - lpts[j])
+            row.append(n / d)
+        weights.append(row)
+    return weights
+
+# Weights of the probed points for each bicubic interpolated point
+def bicubic_weights(pt_cnt, mult, tension):
+    mesh_cnt = (pt_cnt - 1) * mult + 1
+    last_pt = mesh_cnt - 1 - mult
+    weights = []
+    for c in range(mesh_cnt):
+        row = [0.] * pt_cnt
+        if c % mult == 0:
+            row[c // mult] = 1.
+            weights.append(row)
+            continue
+        # Find the control points and t for the cardinal spline
+        if c < mult:
+            i0, i1, i2, i3 = 0, 0, 1, 2
+            t = c / float(mult)
+        elif c > last_pt:
+            i0, i1, i2, i3 = pt_cnt - 3, pt_cnt - 2, pt_cnt - 1, pt_cnt - 1
+            t = (c - last_pt) / float(mult)
+        else:
+            i1 = c // mult
+            i0, i2, i3 = i1 - 1, i1 + 1, i1 + 2
+            t = (c - i1 * mult) / float(mult)
+        t2 = t*t
+        t3 = t2*t
+        h10 = tension * (t3 - 2*t2 + t)
+        h11 = tension * (t3 - t2)
+        row[i0] -= h10
+        row[i1] += 2*t3 - 3*t2 + 1 - h11
+        row[i2] += -2*t3 + 3*t2 + h10
+        row[i3] += h11
+        weights.append(row)
+    return weights
+
+# Calculate y_weights * z_matrix * transpose(x_weights)
+def interpolate_matrix(z_matrix, x_weights, y_weights):
+    if numpy is not None:
+        rows = numpy.dot(numpy.array(z_matrix), numpy.array(x_weights).T)
+        return numpy.dot(numpy.array(y_weights), rows).tolist()
+    x_weights = [[(i, w) for i, w in enumerate(row) if w]
+                 for row in x_weights]
+    rows = [[sum([w * zrow[i] for i, w in wrow]) for wrow in x_weights]
+            for zrow in z_matrix]
+    cols = list(zip(*rows))
+    y_weights = [[(i, w) for i, w in enumerate(row) if w]
+                 for row in y_weights]
+    return [[sum([w * col[i] for i, w in wrow]) for col in cols]
+            for wrow in y_weights]
+
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -105,6 +175,22 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        # optional z adjustment during step generation
+        self.kinematic_compensation = config.getboolean(
+            'kinematic_compensation', False)
+        self.c_mesh = None
+        self.mesh_steppers = []
+        self.homing_active = False
+        if self.kinematic_compensation:
+            ffi_main, ffi_lib = chelper.get_ffi()
+            self.c_mesh = ffi_main.gc(ffi_lib.bed_mesh_alloc(),
+                                      ffi_lib.bed_mesh_free)
+            self.printer.register_event_handler("klippy:ready",
+                                                self.handle_ready)
+            self.printer.register_event_handler(
+                "homing:homing_move_begin", self.handle_homing_move_begin)
+            self.printer.register_event_handler(
+                "homing:homing_move_end", self.handle_homing_move_end)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -128,6 +214,49 @@ class BedMesh:
         self.toolhead = self.printer.lookup_object('toolhead')
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
+    def handle_ready(self):
+        # Wrap the kinematics of steppers that only move the z axis
+        # (this is done after other modules, such as input_shaper,
+        # have setup their stepper kinematics during connect)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        kin = self.toolhead.get_kinematics()
+        for s in kin.get_steppers():
+            sk = ffi_main.gc(ffi_lib.mesh_stepper_alloc(self.c_mesh),
+                             ffi_lib.free)
+            orig_sk = s.set_stepper_kinematics(sk)
+            if ffi_lib.mesh_stepper_set_sk(sk, orig_sk) < 0:
+                s.set_stepper_kinematics(orig_sk)
+                continue
+            self.mesh_steppers.append((s, sk, orig_sk))
+        if not self.mesh_steppers:
+            logging.info("bed_mesh: kinematic compensation not supported"
+                         " by kinematics, splitting moves instead")
+    def handle_homing_move_begin(self, hmove):
+        # Homing and probing moves are not adjusted by the mesh
+        self.homing_active = True
+        self._update_c_mesh()
+    def handle_homing_move_end(self, hmove):
+        self.homing_active = False
+        self._update_c_mesh()
+    def _update_c_mesh(self):
+        if self.c_mesh is None:
+            return
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.toolhead.flush_step_generation()
+        mesh = self.z_mesh
+        if mesh is None or mesh.mesh_matrix is None or self.homing_active:
+            ffi_lib.bed_mesh_set_params(self.c_mesh, 0, 0, 0., 0., 0., 0.,
+                                        0., 0., 0., 0., 0., ffi_main.NULL)
+            return
+        matrix = [z for line in mesh.mesh_matrix for z in line]
+        ret = ffi_lib.bed_mesh_set_params(
+            self.c_mesh, mesh.mesh_x_count, mesh.mesh_y_count,
+            mesh.mesh_x_min, mesh.mesh_y_min,
+            mesh.mesh_x_dist, mesh.mesh_y_dist,
+            mesh.mesh_offsets[0], mesh.mesh_offsets[1],
+            self.fade_start, self.fade_end, self.fade_target, matrix)
+        if ret:
+            raise self.gcode.error("bed_mesh: Unable to set mesh")
     def set_mesh(self, mesh):
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
@@ -142,6 +271,7 @@ class BedMesh:
                     err_target = self.fade_target
                     self.z_mesh = None
                     self.fade_target = 0.
+                    self._update_c_mesh()
                     raise self.gcode.error(
                         "bed_mesh: ERROR, fade_target lies outside of mesh z "
                         "range\nmin: %.4f, max: %.4f, fade_target: %.4f"
@@ -150,6 +280,7 @@ class BedMesh:
             if self.fade_dist <= max(abs(min_z), abs(max_z)):
                 self.z_mesh = None
                 self.fade_target = 0.
+                self._update_c_mesh()
                 raise self.gcode.error(
                     "bed_mesh:  Mesh extends outside of the fade range, "
                     "please see the fade_start and fade_end options in"
@@ -159,6 +290,7 @@ class BedMesh:
             self.fade_target = 0.
         self.z_mesh = mesh
         self.splitter.initialize(mesh, self.fade_target)
+        self._update_c_mesh()
         # cache the current position before a transform takes place
         gcode_move = self.printer.lookup_object('gcode_move')
         gcode_move.reset_last_position()
@@ -205,6 +337,13 @@ class BedMesh:
                     "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
                     % (z, self.fade_target))
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
+        elif self.mesh_steppers:
+            # Only adjust the end position - the z adjustment along
+            # the move is applied by the mesh stepper kinematics
+            x, y, z, e = newpos
+            z_adj = (factor * (self.z_mesh.calc_z(x, y) - self.fade_target)
+                     + self.fade_target)
+            self.toolhead.move([x, y, z + z_adj, e], speed)
         else:
             self.splitter.build_move(self.last_position, newpos, factor)
             while not self.splitter.traverse_complete:
@@ -268,6 +407,7 @@ class BedMesh:
             for i, axis in enumerate(['X', 'Y']):
                 offsets[i] = gcmd.get_float(axis, None)
             self.z_mesh.set_mesh_offsets(offsets)
+            self._update_c_mesh()
             gcode_move = self.printer.lookup_object('gcode_move')
             gcode_move.reset_last_position()
         else:
@@ -756,10 +896,32 @@ class MoveSplitter:
         self.z_factor = factor
         self.z_offset = self._calc_z_offset(prev_pos)
         self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        # Lookup the z offset at each check distance along the move
+        self.check_distances = []
+        self.check_offsets = []
+        self.check_index = 0
+        if self.axis_move[0] or self.axis_move[1]:
+            distance = 0.
+            while distance + self.move_check_distance < self.total_move_length:
+                distance += self.move_check_distance
+                self.check_distances.append(distance)
+            xs, ys = self._get_check_coords(self.check_distances)
+            offset = self.fade_offset
+            self.check_offsets = [factor * (z - offset) + offset
+                                  for z in self.z_mesh.calc_z_many(xs, ys)]
+    def _get_check_coords(self, distances):
+        coords = []
+        for i in range(2):
+            start, end = self.prev_pos[i], self.next_pos[i]
+            if not self.axis_move[i]:
+                coords.append([start] * len(distances))
+                continue
+            length = self.total_move_length
+            coords.append([lerp(d / length, start, end) for d in distances])
+        return coords
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         offset = self.fade_offset
@@ -776,18 +938,18 @@ class MoveSplitter:
                     t, self.prev_pos[i], self.next_pos[i])
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
+            # X and/or Y axis move, traverse if necessary
+            check_offsets = self.check_offsets
+            while self.check_index < len(check_offsets):
+                next_z = check_offsets[self.check_index]
+                self.check_index += 1
+                if abs(next_z - self.z_offset) >= self.split_delta_z:
+                    self.z_offset = next_z
+                    self._set_next_move(
+                        self.check_distances[self.check_index - 1])
+                    return self.current_pos[0], self.current_pos[1], \
+                        self.current_pos[2] + self.z_offset, \
+                        self.current_pos[3]
             # end of move reached
             self.current_pos[:] = self.next_pos
             self.z_offset = self._calc_z_offset(self.current_pos)
@@ -804,6 +966,7 @@ class MoveSplitter:
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_coeffs = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offsets = [0., 0.]
@@ -886,6 +1049,7 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        self._build_coefficients()
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
@@ -901,17 +1065,45 @@ class ZMesh:
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
+    def _build_coefficients(self):
+        # Store the bilinear coefficients of each mesh cell in a flat
+        # list, such that z = c0 + c1*tx + c2*ty + c3*tx*ty
+        tbl = self.mesh_matrix
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0, row1 = tbl[yidx], tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00, z01 = row0[xidx], row0[xidx+1]
+                z10, z11 = row1[xidx], row1[xidx+1]
+                coeffs.append((z00, z01 - z00, z10 - z00,
+                               z11 - z10 - z01 + z00))
+        self.mesh_coeffs = coeffs
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        return self.calc_z_many((x,), (y,))[0]
+    def calc_z_many(self, xs, ys):
+        coeffs = self.mesh_coeffs
+        if coeffs is None:
             # No mesh table generated, no z-adjustment
-            return 0.
+            return [0.] * len(xs)
+        # Load variables to optimize inner loop below
+        x_base = self.mesh_x_min - self.mesh_offsets[0]
+        y_base = self.mesh_y_min - self.mesh_offsets[1]
+        x_inv_dist = 1. / self.mesh_x_dist
+        y_inv_dist = 1. / self.mesh_y_dist
+        x_cells = self.mesh_x_count - 1
+        y_cells = self.mesh_y_count - 1
+        floor = math.floor
+        res = []
+        for x, y in zip(xs, ys):
+            fx = (x - x_base) * x_inv_dist
+            xidx = min(max(int(floor(fx)), 0), x_cells - 1)
+            tx = min(max(fx - xidx, 0.), 1.)
+            fy = (y - y_base) * y_inv_dist
+            yidx = min(max(int(floor(fy)), 0), y_cells - 1)
+            ty = min(max(fy - yidx, 0.), 1.)
+            c0, c1, c2, c3 = coeffs[yidx * x_cells + xidx]
+            res.append(c0 + c1 * tx + (c2 + c3 * tx) * ty)
+        return res
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -919,52 +1111,15 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
-                continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        xcoords = [self.get_x_coordinate(i) for i in range(self.mesh_x_count)]
+        ycoords = [self.get_y_coordinate(i) for i in range(self.mesh_y_count)]
+        x_weights = lagrange_weights(xpts, xcoords)
+        y_weights = lagrange_weights(ypts, ycoords)
+        self.mesh_matrix = interpolate_matrix(z_matrix, x_weights, y_weights)
     def _get_lagrange_coords(self):
         xpts = []
         ypts = []
@@ -973,122 +1128,14 @@ class ZMesh:
         for j in range(self.mesh_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
-        pt_cnt = len(lpts)
-        total = 0.
-        for i in range(pt_cnt):
-            n = 1.
-            d = 1.
-            for j in range(pt_cnt):
-                if j == i:
-                    continue
-                n *= (c - lpts[j])
-                d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
         c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
-        t2 = t*t
-        t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
+        x_weights = bicubic_weights(self.mesh_params['x_count'],
+                                    self.x_mult, c)
+        y_weights = bicubic_weights(self.mesh_params['y_count'],
+                                    self.y_mult, c)
+        self.mesh_matrix = interpolate_matrix(z_matrix, x_weights, y_weights)
 
 
 class ProfileManager:
@@ -21,26 +21,42 @@ class ArcSupport:
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("G2", self.cmd_G2)
         self.gcode.register_command("G3", self.cmd_G2)
+        self.gcode.register_move_handler("G2", self.move_G2)
+        self.gcode.register_move_handler("G3", self.move_G3)
 
     def cmd_G2(self, gcmd):
+        params = {}
+        for axis in "XYZRIJEF":
+            value = gcmd.get_float(axis, None)
+            if value is not None:
+                params[axis] = value
+        clockwise = (gcmd.get_command() == 'G2')
+        self.process_arc(params, gcmd.get_commandline(), clockwise)
+
+    # Handlers for pre-parsed G2/G3 lines
+    def move_G2(self, params, commandline):
+        self.process_arc(params, commandline, True)
+    def move_G3(self, params, commandline):
+        self.process_arc(params, commandline, False)
+
+    def process_arc(self, params, commandline, clockwise):
         gcodestatus = self.gcode_move.get_status()
         if not gcodestatus['absolute_coordinates']:
-            raise gcmd.error("G2/G3 does not support relative move mode")
+            raise self.gcode.error("G2/G3 does not support relative move mode")
         currentPos = gcodestatus['gcode_position']
 
         # Parse parameters
-        asX = gcmd.get_float("X", currentPos[0])
-        asY = gcmd.get_float("Y", currentPos[1])
-        asZ = gcmd.get_float("Z", currentPos[2])
-        if gcmd.get_float("R", None) is not None:
-            raise gcmd.error("G2/G3 does not support R moves")
-        asI = gcmd.get_float("I", 0.)
-        asJ = gcmd.get_float("J", 0.)
+        asX = params.get("X", currentPos[0])
+        asY = params.get("Y", currentPos[1])
+        asZ = params.get("Z", currentPos[2])
+        if "R" in params:
+            raise self.gcode.error("G2/G3 does not support R moves")
+        asI = params.get("I", 0.)
+        asJ = params.get("J", 0.)
         if not asI and not asJ:
-            raise gcmd.error("G2/G3 neither I nor J given")
-        asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
-        clockwise = (gcmd.get_command() == 'G2')
+            raise self.gcode.error("G2/G3 neither I nor J given")
+        asE = params.get("E")
+        asF = params.get("F")
 
         # Build list of linear coordinates to move to
         coords = self.planArc(currentPos, [asX, asY, asZ], [asI, asJ],
@@ -51,7 +67,7 @@ class ArcSupport:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / len(coords)
 
-        # Convert coords into G1 commands
+        # Convert coords into G1 moves
         for coord in coords:
             g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
             if e_per_move:
@@ -60,8 +76,7 @@ class ArcSupport:
                     e_base += e_per_move
             if asF is not None:
                 g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+            self.gcode_move.process_move(g1_params, commandline)
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
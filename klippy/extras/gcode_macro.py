@@ -140,6 +140,9 @@ class GCodeMacro:
                                         name, self.cmd_SET_GCODE_VARIABLE,
                                         desc=self.cmd_SET_GCODE_VARIABLE_help)
         self.in_script = False
+        self.status_name = config.get_name()
+        self.query_status = printer.lookup_object('query_status')
+        self.query_status.register_status_tracking(self.status_name)
         self.variables = {}
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
@@ -171,7 +174,10 @@ class GCodeMacro:
             literal = ast.literal_eval(value)
         except ValueError as e:
             raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
-        self.variables[variable] = literal
+        v = dict(self.variables)
+        v[variable] = literal
+        self.variables = v
+        self.query_status.note_status_change(self.status_name)
     def cmd(self, gcmd):
         if self.in_script:
             raise gcmd.error("Macro %s called recursively" % (self.alias,))
@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, struct, base64
 import chelper
 
 API_UPDATE_INTERVAL = 0.500
@@ -11,17 +11,21 @@ API_UPDATE_INTERVAL = 0.500
 # Helper to periodically transmit data to a set of API clients
 class APIDumpHelper:
     def __init__(self, printer, data_cb, startstop_cb=None,
-                 update_interval=API_UPDATE_INTERVAL):
+                 update_interval=API_UPDATE_INTERVAL, data_format=None):
         self.printer = printer
         self.data_cb = data_cb
+        # Struct format of a (flattened) row of the "data" messages
+        self.data_format = data_format
         if startstop_cb is None:
             startstop_cb = (lambda is_start: None)
         self.startstop_cb = startstop_cb
         self.update_interval = update_interval
         self.update_timer = None
         self.clients = {}
+        self.dropped_msgs = {}
     def _stop(self):
         self.clients.clear()
+        self.dropped_msgs.clear()
         if self.update_timer is None:
             return
         reactor = self.printer.get_reactor()
@@ -48,13 +52,38 @@ class APIDumpHelper:
     def add_client(self, web_request):
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
-        self.clients[cconn] = template
+        is_binary = web_request.get('binary', False, types=(bool,))
+        if is_binary and self.data_format is None:
+            raise web_request.error("Binary data not supported")
+        self.clients[cconn] = (template, 'binary' if is_binary else 'json')
         self._start()
-    def add_internal_client(self):
-        cconn = InternalDumpClient()
-        self.clients[cconn] = {}
+    def add_internal_client(self, msg_cb=None):
+        cconn = InternalDumpClient(msg_cb)
+        self.clients[cconn] = ({}, 'internal')
         self._start()
         return cconn
+    def _encode_json(self, msg):
+        # The "data" may be provided as a numpy array
+        data = msg.get('data')
+        if not hasattr(data, 'tolist'):
+            return msg
+        jmsg = dict(msg)
+        jmsg['data'] = data.tolist()
+        return jmsg
+    def _encode_binary(self, msg):
+        # Send "data" rows as base64 encoded little-endian packed values
+        data = self._encode_json(msg)['data']
+        if data and [v for v in data[0] if type(v) == tuple]:
+            flat = [v for row in data for f in row
+                    for v in (f if type(f) == tuple else (f,))]
+        else:
+            flat = [v for row in data for v in row]
+        fmt = self.data_format
+        packed = struct.pack('<' + fmt * len(data), *flat)
+        bmsg = dict(msg)
+        bmsg['data'] = base64.b64encode(packed).decode()
+        bmsg['data_format'] = '<' + fmt
+        return bmsg
     def _update(self, eventtime):
         try:
             msg = self.data_cb(eventtime)
@@ -63,20 +92,40 @@ class APIDumpHelper:
             return self._stop()
         if not msg:
             return eventtime + self.update_interval
-        for cconn, template in list(self.clients.items()):
+        # Internal clients receive the data unconverted
+        emsgs = {'internal': msg}
+        for cconn, (template, encoding) in list(self.clients.items()):
             if cconn.is_closed():
                 del self.clients[cconn]
+                self.dropped_msgs.pop(cconn, None)
                 if not self.clients:
                     return self._stop()
                 continue
+            if cconn.is_congested():
+                # Drop messages while the client is not keeping up
+                self.dropped_msgs[cconn] = self.dropped_msgs.get(cconn, 0) + 1
+                continue
+            if cconn in self.dropped_msgs:
+                logging.info("API Dump Helper dropped %d messages"
+                             " for client %s",
+                             self.dropped_msgs.pop(cconn), id(cconn))
+            emsg = emsgs.get(encoding)
+            if emsg is None:
+                if encoding == 'binary':
+                    emsg = emsgs[encoding] = self._encode_binary(msg)
+                else:
+                    emsg = emsgs[encoding] = self._encode_json(msg)
             tmp = dict(template)
-            tmp['params'] = msg
+            tmp['params'] = emsg
             cconn.send(tmp)
         return eventtime + self.update_interval
 
 # An "internal webhooks" wrapper for using APIDumpHelper internally
 class InternalDumpClient:
-    def __init__(self):
+    def __init__(self, msg_cb=None):
+        # If msg_cb is provided, messages are passed to it instead of
+        # being stored
+        self.msg_cb = msg_cb
         self.msgs = []
         self.is_done = False
     def get_messages(self):
@@ -85,7 +134,12 @@ class InternalDumpClient:
         self.is_done = True
     def is_closed(self):
         return self.is_done
+    def is_congested(self):
+        return False
     def send(self, msg):
+        if self.msg_cb is not None:
+            self.msg_cb(msg)
+            return
         self.msgs.append(msg)
         if len(self.msgs) >= 10000:
             # Avoid filling up memory with too many samples
@@ -97,7 +151,8 @@ class DumpStepper:
         self.printer = printer
         self.mcu_stepper = mcu_stepper
         self.last_api_clock = 0
-        self.api_dump = APIDumpHelper(printer, self._api_update)
+        self.api_dump = APIDumpHelper(printer, self._api_update,
+                                      data_format='Iih')
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint("motion_report/dump_stepper", "name",
                                  mcu_stepper.get_name(), self._add_api_client)
@@ -160,7 +215,8 @@ class DumpTrapQ:
         self.name = name
         self.trapq = trapq
         self.last_api_msg = (0., 0.)
-        self.api_dump = APIDumpHelper(printer, self._api_update)
+        self.api_dump = APIDumpHelper(printer, self._api_update,
+                                      data_format='10d')
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint("motion_report/dump_trapq", "name", name,
                                  self._add_api_client)
@@ -195,13 +251,10 @@ class DumpTrapQ:
         count = ffi_lib.trapq_extract_old(self.trapq, data, 1, 0., print_time)
         if not count:
             return None, None
-        move = data[0]
-        move_time = max(0., min(move.move_t, print_time - move.print_time))
-        dist = (move.start_v + .5 * move.accel * move_time) * move_time;
-        pos = (move.start_x + move.x_r * dist, move.start_y + move.y_r * dist,
-               move.start_z + move.z_r * dist)
-        velocity = move.start_v + move.accel * move_time
-        return pos, velocity
+        sample = ffi_main.new('struct pull_position[1]')
+        ffi_lib.trapq_sample_moves(data, 1, [print_time], sample, 1)
+        s = sample[0]
+        return (s.x, s.y, s.z), s.velocity
     def _api_update(self, eventtime):
         qtime = self.last_api_msg[0] + min(self.last_api_msg[1], 0.100)
         data, cdata = self.extract_trapq(qtime, NEVER_TIME)
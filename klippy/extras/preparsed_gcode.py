@@ -0,0 +1,221 @@
+# Support for pre-parsed (binary) versions of g-code files
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, bisect, logging
+import gcode
+
+# A pre-parsed file contains a header followed by a series of records
+# and an index.  Each record covers one or more lines of the original
+# g-code file (any blank and comment only lines followed by a single
+# command line).  Plain motion commands are stored as a command id and
+# their float parameters, all other commands are stored as text.
+PREPARSED_MAGIC = b"KLIPGCP1"
+HEADER = struct.Struct('<8sQdQ') # magic, gcode size, gcode mtime, index pos
+RECORD = struct.Struct('<BBI') # command id, parameter mask, gcode size
+SCRIPT = struct.Struct('<I') # script length
+INDEX_ENTRY = struct.Struct('<QQ') # gcode position, record position
+INDEX_INTERVAL = 1024
+READ_SIZE = 65536
+
+MOVE_COMMANDS = ['G0', 'G1', 'G2', 'G3']
+CMD_SCRIPT = 255
+PARAM_NAMES = "XYZEFIJR"
+
+# Parameter names and struct for each possible parameter mask
+PARAM_FORMATS = []
+for mask in range(1 << len(PARAM_NAMES)):
+    names = tuple([n for i, n in enumerate(PARAM_NAMES) if mask & (1 << i)])
+    PARAM_FORMATS.append((names, struct.Struct('<%dd' % (len(names),))))
+
+def get_preparsed_filename(gcode_filename):
+    dirname, basename = os.path.split(gcode_filename)
+    return os.path.join(dirname, "." + basename + ".preparsed")
+
+
+######################################################################
+# Conversion
+######################################################################
+
+def _encode_line(line):
+    # Return the record (without gcode size) for a single command line
+    cmdline = line.strip()
+    cpos = cmdline.find(';')
+    if cpos >= 0:
+        cmdline = cmdline[:cpos].rstrip()
+    if not cmdline:
+        return None
+    move = gcode.parse_move_line(cmdline)
+    if move is not None:
+        cmd, params = move
+        if (cmd in MOVE_COMMANDS and not [p for p in params
+                                          if p not in PARAM_NAMES]
+            and params.get('F', 1.) > 0.):
+            mask = sum([1 << i for i, n in enumerate(PARAM_NAMES)
+                        if n in params])
+            names, fmt = PARAM_FORMATS[mask]
+            return (MOVE_COMMANDS.index(cmd), mask,
+                    fmt.pack(*[params[n] for n in names]))
+    data = line.rstrip('\r\n').encode('utf-8')
+    return CMD_SCRIPT, 0, SCRIPT.pack(len(data)) + data
+
+def _write_records(inf, outf, gcode_stat):
+    index = []
+    outf.write(HEADER.pack(PREPARSED_MAGIC, 0, 0., 0))
+    record_pos = HEADER.size
+    record_start = pending = count = 0
+    for rawline in inf:
+        if not rawline.endswith(b'\n'):
+            # virtual_sdcard ignores a final unterminated line
+            break
+        pending += len(rawline)
+        record = _encode_line(rawline.decode('utf-8', 'replace'))
+        if record is None:
+            continue
+        cmd_id, mask, params = record
+        if not count % INDEX_INTERVAL:
+            index.append((record_start, record_pos))
+        data = RECORD.pack(cmd_id, mask, pending) + params
+        outf.write(data)
+        record_pos += len(data)
+        record_start += pending
+        pending = 0
+        count += 1
+    if pending:
+        # Trailing blank and comment lines
+        if not count % INDEX_INTERVAL:
+            index.append((record_start, record_pos))
+        outf.write(RECORD.pack(CMD_SCRIPT, 0, pending) + SCRIPT.pack(0))
+        record_pos += RECORD.size + SCRIPT.size
+    for entry in index:
+        outf.write(INDEX_ENTRY.pack(*entry))
+    outf.seek(0)
+    outf.write(HEADER.pack(PREPARSED_MAGIC, gcode_stat.st_size,
+                           gcode_stat.st_mtime, record_pos))
+    return count
+
+# Convert a g-code file to its pre-parsed form
+def convert(gcode_filename, dest_filename=None):
+    if dest_filename is None:
+        dest_filename = get_preparsed_filename(gcode_filename)
+    gcode_stat = os.stat(gcode_filename)
+    temp_filename = dest_filename + ".tmp"
+    try:
+        with open(gcode_filename, 'rb') as inf:
+            with open(temp_filename, 'wb') as outf:
+                count = _write_records(inf, outf, gcode_stat)
+        os.rename(temp_filename, dest_filename)
+    except:
+        # Don't leave a partial file behind
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    return count
+
+
+######################################################################
+# Reading
+######################################################################
+
+class PreparsedFile:
+    def __init__(self, f, index_pos, index):
+        self.file = f
+        self.index_pos = index_pos
+        self.index = index
+        self.index_gcode_pos = [gcode_pos for gcode_pos, pos in index]
+        self.pos = HEADER.size
+        self.data = b""
+    def close(self):
+        self.file.close()
+    def _decode(self, data, pos):
+        # Decode the record at the given offset (returns None if the
+        # record is not completely contained in the data)
+        if pos + RECORD.size > len(data):
+            return None
+        cmd_id, mask, size = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if cmd_id == CMD_SCRIPT:
+            if pos + SCRIPT.size > len(data):
+                return None
+            script_len, = SCRIPT.unpack_from(data, pos)
+            pos += SCRIPT.size
+            if pos + script_len > len(data):
+                return None
+            script = data[pos:pos+script_len].decode('utf-8', 'replace')
+            return pos + script_len, (size, None, script)
+        names, fmt = PARAM_FORMATS[mask]
+        if pos + fmt.size > len(data):
+            return None
+        params = dict(zip(names, fmt.unpack_from(data, pos)))
+        return pos + fmt.size, (size, MOVE_COMMANDS[cmd_id], params)
+    def read_records(self):
+        # Return a list of (gcode size, command, params_or_script)
+        # tuples - the command is None for text scripts
+        data = self.data
+        records = []
+        pos = 0
+        while 1:
+            res = self._decode(data, pos)
+            if res is not None:
+                pos, record = res
+                records.append(record)
+                continue
+            if records or self.pos >= self.index_pos:
+                break
+            # Read more data (a single record may be larger than READ_SIZE)
+            self.file.seek(self.pos)
+            count = min(READ_SIZE, self.index_pos - self.pos)
+            data += self.file.read(count)
+            self.pos += count
+        self.data = data[pos:]
+        return records
+    def seek(self, gcode_pos):
+        # Position the reader at the record starting at the given
+        # position in the g-code file.  Returns False if that position
+        # is not the start of a record.
+        i = bisect.bisect_right(self.index_gcode_pos, gcode_pos) - 1
+        if i < 0:
+            return False
+        record_gcode_pos, pos = self.index[i]
+        end_pos = self.index_pos
+        if i + 1 < len(self.index):
+            end_pos = self.index[i + 1][1]
+        self.file.seek(pos)
+        data = self.file.read(end_pos - pos)
+        rpos = 0
+        while record_gcode_pos < gcode_pos:
+            res = self._decode(data, rpos)
+            if res is None:
+                return False
+            rpos, record = res
+            record_gcode_pos += record[0]
+        if record_gcode_pos != gcode_pos:
+            return False
+        self.pos = pos + rpos
+        self.data = b""
+        return True
+
+# Open the pre-parsed version of a g-code file (if it is available and
+# up to date)
+def open_preparsed(gcode_filename):
+    filename = get_preparsed_filename(gcode_filename)
+    if not os.path.exists(filename):
+        return None
+    try:
+        gcode_stat = os.stat(gcode_filename)
+        f = open(filename, 'rb')
+        magic, size, mtime, index_pos = HEADER.unpack(f.read(HEADER.size))
+        if (magic != PREPARSED_MAGIC or size != gcode_stat.st_size
+            or mtime != gcode_stat.st_mtime):
+            logging.info("Ignoring outdated pre-parsed file %s", filename)
+            f.close()
+            return None
+        f.seek(index_pos)
+        data = f.read()
+        index = [INDEX_ENTRY.unpack_from(data, i)
+                 for i in range(0, len(data), INDEX_ENTRY.size)]
+    except:
+        logging.exception("Unable to open pre-parsed file %s", filename)
+        return None
+    return PreparsedFile(f, index_pos, index)
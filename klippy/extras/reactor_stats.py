@@ -0,0 +1,32 @@
+# Report time spent in reactor timer and file descriptor callbacks
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorStats:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        reactor = self.printer.get_reactor()
+        self.profiler = reactor.setup_profiler()
+        self.last_eventtime = reactor.monotonic()
+        # Register webhook if server is available
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor_stats/status",
+                                   self._handle_web_request)
+    def _handle_web_request(self, web_request):
+        web_request.send(self.profiler.get_stats())
+    def stats(self, eventtime):
+        istats = self.profiler.get_interval_stats()
+        interval = eventtime - self.last_eventtime
+        self.last_eventtime = eventtime
+        load = 0.
+        if interval > 0.:
+            load = istats['busy'] / interval
+        return False, ("reactor: reactor_load=%.3f max_late=%.6f late_owner=%s"
+                       " max_stall=%.6f stall_owner=%s" % (
+                           load, istats['max_late'], istats['max_late_owner'],
+                           istats['max_stall'], istats['max_stall_owner']))
+
+def load_config(config):
+    return ReactorStats(config)
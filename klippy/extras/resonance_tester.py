@@ -166,12 +166,21 @@ class ResonanceTester:
 
                 raw_values = []
                 for chip_axis, chip in self.accel_chips:
-                    if axis.matches(chip_axis):
+                    if not axis.matches(chip_axis):
+                        continue
+                    if helper is not None and raw_name_suffix is None:
+                        # Calculate the frequency response while the
+                        # data is being collected
+                        psd_accumulator = helper.start_psd_accumulator()
+                        aclient = chip.start_internal_client(
+                                psd_accumulator.add_samples)
+                    else:
+                        psd_accumulator = None
                         aclient = chip.start_internal_client()
-                        raw_values.append((chip_axis, aclient))
+                    raw_values.append((chip_axis, aclient, psd_accumulator))
                 # Generate moves
                 self.test.run_test(axis, gcmd)
-                for chip_axis, aclient in raw_values:
+                for chip_axis, aclient, psd_accumulator in raw_values:
                     aclient.finish_measurements()
                     if raw_name_suffix is not None:
                         raw_name = self.get_filename(
@@ -183,12 +192,16 @@ class ResonanceTester:
                                 "%s file" % (raw_name,))
                 if helper is None:
                     continue
-                for chip_axis, aclient in raw_values:
+                for chip_axis, aclient, psd_accumulator in raw_values:
                     if not aclient.has_valid_samples():
                         raise gcmd.error(
                                 "%s-axis accelerometer measured no data" % (
                                     chip_axis,))
-                    new_data = helper.process_accelerometer_data(aclient)
+                    if psd_accumulator is not None:
+                        new_data = helper.process_accelerometer_data(
+                                psd_accumulator)
+                    else:
+                        new_data = helper.process_accelerometer_data(aclient)
                     if calibration_data[axis] is None:
                         calibration_data[axis] = new_data
                     else:
@@ -252,14 +265,23 @@ class ResonanceTester:
         calibration_data = self._run_test(gcmd, calibrate_axes, helper)
 
         configfile = self.printer.lookup_object('configfile')
+        axis_names = [axis.get_name() for axis in calibrate_axes]
+        gcmd.respond_info(
+                "Calculating the best input shaper parameters for %s axis"
+                % (", ".join(axis_names),))
+        loggers = []
         for axis in calibrate_axes:
-            axis_name = axis.get_name()
-            gcmd.respond_info(
-                    "Calculating the best input shaper parameters for %s axis"
-                    % (axis_name,))
             calibration_data[axis].normalize_to_frequencies()
-            best_shaper, all_shapers = helper.find_best_shaper(
-                    calibration_data[axis], max_smoothing, gcmd.respond_info)
+            logger = gcmd.respond_info
+            if len(calibrate_axes) > 1:
+                logger = (lambda msg, prefix=axis.get_name():
+                          gcmd.respond_info("%s: %s" % (prefix, msg)))
+            loggers.append(logger)
+        results = helper.find_best_shapers(
+                [calibration_data[axis] for axis in calibrate_axes],
+                max_smoothing, loggers)
+        for axis, (best_shaper, all_shapers) in zip(calibrate_axes, results):
+            axis_name = axis.get_name()
             gcmd.respond_info(
                     "Recommended shaper_type_%s = %s, shaper_freq_%s = %.1f Hz"
                     % (axis_name, best_shaper.name,
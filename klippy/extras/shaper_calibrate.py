@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing
+import collections, importlib, logging, math, multiprocessing, traceback
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
@@ -53,6 +53,91 @@ class CalibrationData:
         return self._psd_map[axis]
 
 
+# Incremental calculation of the power spectral density (PSD) of
+# accelerometer data using Welch's algorithm.  Samples may be added in
+# batches as they arrive - only the samples of the last incomplete
+# window are kept.
+class PSDAccumulator:
+    def __init__(self, numpy):
+        self.numpy = numpy
+        self.pending = []
+        self.sample_count = 0
+        self.first_time = self.last_time = 0.
+        self.nfft = self.window_count = 0
+        self.window = self.psd_sum = None
+    def _setup(self, sampling_freq):
+        np = self.numpy
+        # Round up to the nearest power of 2 for faster FFT
+        self.nfft = 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+        self.window = np.kaiser(self.nfft, 6.)
+        self.psd_sum = np.zeros((self.nfft // 2 + 1, 3))
+    def _get_sampling_freq(self):
+        return self.sample_count / (self.last_time - self.first_time)
+    def _process_windows(self):
+        np = self.numpy
+        nfft = self.nfft
+        x = self.pending[0]
+        if len(self.pending) > 1:
+            x = np.concatenate(self.pending)
+        # Split into overlapping windows of size nfft
+        overlap = nfft // 2
+        step = nfft - overlap
+        n_windows = max((x.shape[0] - overlap) // step, 0)
+        if n_windows:
+            windows = np.lib.stride_tricks.as_strided(
+                    x, shape=(n_windows, nfft, 3),
+                    strides=(step * x.strides[0],) + x.strides,
+                    writeable=False)
+            # First detrend, then apply windowing function
+            windows = self.window[:,np.newaxis] * (
+                    windows - windows.mean(axis=1)[:,np.newaxis,:])
+            # Calculate frequency response for each window using FFT
+            result = np.fft.rfft(windows, n=nfft, axis=1)
+            self.psd_sum += (result.real**2 + result.imag**2).sum(axis=0)
+            self.window_count += n_windows
+            x = x[n_windows * step:]
+        self.pending = [np.ascontiguousarray(x)]
+    def add_samples(self, data):
+        # Add an Nx4 array of (time, accel_x, accel_y, accel_z) samples
+        if not len(data):
+            return
+        if not self.sample_count:
+            self.first_time = data[0,0]
+        self.last_time = data[-1,0]
+        self.sample_count += data.shape[0]
+        self.pending.append(data[:,1:])
+        if not self.nfft:
+            # Wait for enough data to determine the sampling frequency
+            if self.last_time - self.first_time < 2. * WINDOW_T_SEC:
+                return
+            self._setup(self._get_sampling_freq())
+        self._process_windows()
+    def get_sample_count(self):
+        return self.sample_count
+    def get_calibration_data(self):
+        np = self.numpy
+        if self.sample_count < 2 or self.last_time <= self.first_time:
+            return None
+        sampling_freq = self._get_sampling_freq()
+        if not self.nfft:
+            self._setup(sampling_freq)
+            self._process_windows()
+        if self.sample_count <= self.nfft:
+            return None
+        # Compensation for windowing loss
+        scale = 1.0 / (self.window**2).sum()
+        # Welch's algorithm: average response over windows
+        psd = self.psd_sum * (scale / (sampling_freq * self.window_count))
+        # For one-sided FFT output the response must be doubled, except
+        # the last point for unpaired Nyquist frequency (assuming even nfft)
+        # and the 'DC' term (0 Hz)
+        psd[1:-1,:] *= 2.
+        # Calculate the frequency bins
+        freqs = np.fft.rfftfreq(self.nfft, 1. / sampling_freq)
+        px, py, pz = [psd[:,i].copy() for i in range(3)]
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
@@ -69,9 +154,7 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
-    def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
+    def _start_background_process(self, method, args):
         import queuelogger
         parent_conn, child_conn = multiprocessing.Pipe()
         def wrapper():
@@ -88,62 +171,63 @@ class ShaperCalibrate:
         calc_proc = multiprocessing.Process(target=wrapper)
         calc_proc.daemon = True
         calc_proc.start()
-        # Wait for the process to finish
+        return calc_proc, parent_conn
+    def background_process_exec_many(self, jobs, result_cb=None):
+        # Run a list of (method, args) jobs in parallel background
+        # processes (up to one per cpu).  The optional result_cb(index,
+        # result) is invoked as each job completes.
+        results = [None] * len(jobs)
+        if self.printer is None:
+            for i, (method, args) in enumerate(jobs):
+                results[i] = method(*args)
+                if result_cb is not None:
+                    result_cb(i, results[i])
+            return results
+        max_procs = multiprocessing.cpu_count()
+        pending = list(enumerate(jobs))
+        running = []
         reactor = self.printer.get_reactor()
         gcode = self.printer.lookup_object("gcode")
         eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
-
-    def _split_into_windows(self, x, window_size, overlap):
-        # Memory-efficient algorithm to split an input 'x' into a series
-        # of overlapping windows
-        step_between_windows = window_size - overlap
-        n_windows = (x.shape[-1] - overlap) // step_between_windows
-        shape = (window_size, n_windows)
-        strides = (x.strides[-1], step_between_windows * x.strides[-1])
-        return self.numpy.lib.stride_tricks.as_strided(
-                x, shape=shape, strides=strides, writeable=False)
-
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
-        np = self.numpy
-        window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
-        scale = 1.0 / (window**2).sum()
-
-        # Split into overlapping windows of size nfft
-        overlap = nfft // 2
-        x = self._split_into_windows(x, nfft, overlap)
-
-        # First detrend, then apply windowing function
-        x = window[:, None] * (x - np.mean(x, axis=0))
-
-        # Calculate frequency response for each window using FFT
-        result = np.fft.rfft(x, n=nfft, axis=0)
-        result = np.conjugate(result) * result
-        result *= scale / fs
-        # For one-sided FFT output the response must be doubled, except
-        # the last point for unpaired Nyquist frequency (assuming even nfft)
-        # and the 'DC' term (0 Hz)
-        result[1:-1,:] *= 2.
-
-        # Welch's algorithm: average response over windows
-        psd = result.real.mean(axis=-1)
-
-        # Calculate the frequency bins
-        freqs = np.fft.rfftfreq(nfft, 1. / fs)
-        return freqs, psd
+        try:
+            while pending or running:
+                while pending and len(running) < max_procs:
+                    i, (method, args) = pending.pop(0)
+                    calc_proc, conn = self._start_background_process(
+                        method, args)
+                    running.append((i, calc_proc, conn))
+                completed = False
+                for job in list(running):
+                    i, calc_proc, conn = job
+                    if not conn.poll():
+                        if not calc_proc.is_alive() and not conn.poll():
+                            raise self.error("Remote calculation failed")
+                        continue
+                    # Return results
+                    is_err, res = conn.recv()
+                    if is_err:
+                        raise self.error(
+                            "Error in remote calculation: %s" % (res,))
+                    calc_proc.join()
+                    conn.close()
+                    running.remove(job)
+                    completed = True
+                    results[i] = res
+                    if result_cb is not None:
+                        result_cb(i, res)
+                if completed:
+                    continue
+                if eventtime > last_report_time + 5.:
+                    last_report_time = eventtime
+                    gcode.respond_info("Wait for calculations..", log=False)
+                eventtime = reactor.pause(eventtime + .1)
+        finally:
+            for i, calc_proc, conn in running:
+                calc_proc.terminate()
+                conn.close()
+        return results
+    def background_process_exec(self, method, args):
+        return self.background_process_exec_many([(method, args)])[0]
 
     def calc_freq_response(self, raw_values):
         np = self.numpy
@@ -151,179 +235,201 @@ class ShaperCalibrate:
             return None
         if isinstance(raw_values, np.ndarray):
             data = raw_values
+        elif hasattr(raw_values, 'get_samples_array'):
+            data = raw_values.get_samples_array()
+            if not len(data):
+                return None
         else:
             samples = raw_values.get_samples()
             if not samples:
                 return None
             data = np.array(samples)
 
-        N = data.shape[0]
-        T = data[-1,0] - data[0,0]
-        SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
-        if N <= M:
-            return None
+        psd_accumulator = PSDAccumulator(np)
+        psd_accumulator.add_samples(data)
+        return psd_accumulator.get_calibration_data()
 
-        # Calculate PSD (power spectral density) of vibrations per
-        # frequency bins (the same bins for X, Y, and Z)
-        fx, px = self._psd(data[:,1], SAMPLING_FREQ, M)
-        fy, py = self._psd(data[:,2], SAMPLING_FREQ, M)
-        fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
-        return CalibrationData(fx, px+py+pz, px, py, pz)
+    def start_psd_accumulator(self):
+        return PSDAccumulator(self.numpy)
 
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+        if isinstance(data, PSDAccumulator):
+            # The PSD was already calculated while the data was collected
+            calibration_data = data.get_calibration_data()
+        else:
+            calibration_data = self.background_process_exec(
+                    self.calc_freq_response, (data,))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+    def _get_shaper_arrays(self, shaper_cfg, test_freqs):
+        # Return the pulse amplitudes and times of the shapers for all
+        # test frequencies as (len(test_freqs), n) arrays
         np = self.numpy
-
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        shapers = [shaper_cfg.init_func(
+            test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        return A, T
+
+    def _estimate_shaper(self, A, T, test_damping_ratio, test_freqs):
+        # Evaluate the response of all the shapers to each test frequency
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
-
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
+        W = A[:,np.newaxis,:] * np.exp(-damping[:,np.newaxis]
+                                       * (T[:,-1:] - T)[:,np.newaxis,:])
+        S = W * np.sin(omega_d[:,np.newaxis] * T[:,np.newaxis,:])
+        C = W * np.cos(omega_d[:,np.newaxis] * T[:,np.newaxis,:])
+        return (np.sqrt(S.sum(axis=-1)**2 + C.sum(axis=-1)**2)
+                * inv_D[:,np.newaxis])
+
+    def _estimate_remaining_vibrations(self, A, T, test_damping_ratio,
                                        freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
+        vals = self._estimate_shaper(A, T, test_damping_ratio, freq_bins)
         # The input shaper can only reduce the amplitude of vibrations by
         # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
         # threshold can be igonred
         vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
         remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
+                vals * psd - vibr_threshold, 0).sum(axis=-1)
         all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
         return (remaining_vibrations / all_vibrations, vals)
 
-    def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
-        half_accel = accel * .5
-
-        A, T = shaper
-        inv_D = 1. / sum(A)
-        n = len(T)
+    def _get_smoothing_coeffs(self, A, T, scv):
+        # The offsets for 90 and 180 degrees turns are linear in the
+        # acceleration: offset_90 = c90 + k90 * accel and
+        # offset_180 = k180 * accel
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
         # Calculate input shaper shift
-        ts = sum([A[i] * T[i] for i in range(n)]) * inv_D
-
-        # Calculate offset for 90 and 180 degrees turn
-        offset_90 = offset_180 = 0.
-        for i in range(n):
-            if T[i] >= ts:
-                # Calculate offset for one of the axes
-                offset_90 += A[i] * (scv + half_accel * (T[i]-ts)) * (T[i]-ts)
-            offset_180 += A[i] * half_accel * (T[i]-ts)**2
-        offset_90 *= inv_D * math.sqrt(2.)
-        offset_180 *= inv_D
-        return max(offset_90, offset_180)
+        ts = (A * T).sum(axis=-1) * inv_D
+        dt = T - ts[:,np.newaxis]
+        # Calculate offset for one of the axes
+        A_90 = np.where(T >= ts[:,np.newaxis], A, 0.)
+        c90 = (A_90 * scv * dt).sum(axis=-1) * inv_D * math.sqrt(2.)
+        k90 = (A_90 * .5 * dt**2).sum(axis=-1) * inv_D * math.sqrt(2.)
+        k180 = (A * .5 * dt**2).sum(axis=-1) * inv_D
+        return c90, k90, k180
+
+    def _get_shaper_smoothing(self, A, T, accel=5000, scv=5.):
+        c90, k90, k180 = self._get_smoothing_coeffs(A, T, scv)
+        return self.numpy.maximum(c90 + k90 * accel, k180 * accel)
+
+    def _get_shaper_max_accel(self, A, T, scv=5.):
+        # Just some empirically chosen value which produces good projections
+        # for max_accel without much smoothing
+        TARGET_SMOOTHING = 0.12
+        np = self.numpy
+        c90, k90, k180 = self._get_smoothing_coeffs(A, T, scv)
+        with np.errstate(divide='ignore'):
+            max_accel = np.minimum((TARGET_SMOOTHING - c90) / k90,
+                                   TARGET_SMOOTHING / k180)
+        return np.maximum(max_accel, 0.)
 
     def fit_shaper(self, shaper_cfg, calibration_data, max_smoothing):
         np = self.numpy
 
         test_freqs = np.arange(shaper_cfg.min_freq, MAX_SHAPER_FREQ, .2)
+        # Test frequencies are processed from the highest to the lowest
+        test_freqs = test_freqs[::-1]
 
         freq_bins = calibration_data.freq_bins
         psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
         freq_bins = freq_bins[freq_bins <= MAX_FREQ]
 
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(
-                    test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
-            shaper_smoothing = self._get_shaper_smoothing(shaper)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper)
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
-                # The current frequency is better for the shaper.
-                best_res = results[-1]
-        # Try to find an 'optimal' shapper configuration: the one that is not
-        # much worse than the 'best' one, but gives much less smoothing
-        selected = best_res
-        for res in results[::-1]:
-            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
-                selected = res
-        return selected
-
-    def _bisect(self, func):
-        left = right = 1.
-        while not func(left):
-            right = left
-            left *= .5
-        if right == left:
-            while func(right):
-                right *= 2.
-        while right - left > 1e-8:
-            middle = (left + right) * .5
-            if func(middle):
-                left = middle
-            else:
-                right = middle
-        return left
+        A, T = self._get_shaper_arrays(shaper_cfg, test_freqs)
+        shaper_smoothing = self._get_shaper_smoothing(A, T)
+        count = len(test_freqs)
+        if max_smoothing:
+            over_smoothing = np.nonzero(shaper_smoothing[1:] > max_smoothing)[0]
+            if len(over_smoothing):
+                count = over_smoothing[0] + 1
+        A, T = A[:count], T[:count]
+        shaper_smoothing = shaper_smoothing[:count]
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        shaper_vibrations = np.zeros(count)
+        shaper_vals = np.zeros(shape=(count, len(freq_bins)))
+        for dr in TEST_DAMPING_RATIOS:
+            vibrations, vals = self._estimate_remaining_vibrations(
+                    A, T, dr, freq_bins, psd)
+            shaper_vals = np.maximum(shaper_vals, vals)
+            shaper_vibrations = np.maximum(shaper_vibrations, vibrations)
+        max_accel = self._get_shaper_max_accel(A, T)
+        # The score trying to minimize vibrations, but also accounting
+        # the growth of smoothing. The formula itself does not have any
+        # special meaning, it simply shows good results on real user data
+        shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
+                                           shaper_vibrations * .2 + .01)
+        # The best frequency for the shaper (the first one found with
+        # the least vibrations)
+        best = selected = int(np.argmin(shaper_vibrations))
+        if count == len(test_freqs):
+            # Try to find an 'optimal' shapper configuration: the one that is
+            # not much worse than the 'best' one, but gives much less
+            # smoothing (skipped if the search stopped due to too much
+            # smoothing)
+            for i in range(count-1, -1, -1):
+                if (shaper_vibrations[i] < shaper_vibrations[best] * 1.1
+                        and shaper_score[i] < shaper_score[selected]):
+                    selected = i
+        return CalibrationResult(
+                name=shaper_cfg.name, freq=test_freqs[selected],
+                vals=shaper_vals[selected], vibrs=shaper_vibrations[selected],
+                smoothing=shaper_smoothing[selected],
+                score=shaper_score[selected], max_accel=max_accel[selected])
 
     def find_shaper_max_accel(self, shaper):
-        # Just some empirically chosen value which produces good projections
-        # for max_accel without much smoothing
-        TARGET_SMOOTHING = 0.12
-        max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
-            shaper, test_accel) <= TARGET_SMOOTHING)
-        return max_accel
+        np = self.numpy
+        A, T = np.array([shaper[0]]), np.array([shaper[1]])
+        return self._get_shaper_max_accel(A, T)[0]
 
-    def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
+    def _select_best_shaper(self, shapers):
         best_shaper = None
-        all_shapers = []
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in AUTOTUNE_SHAPERS:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
-            if logger is not None:
-                logger("Fitted shaper '%s' frequency = %.1f Hz "
-                       "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
-                           shaper.name, shaper.freq, shaper.vibrs * 100.,
-                           shaper.smoothing))
-                logger("To avoid too much smoothing with '%s', suggested "
-                       "max_accel <= %.0f mm/sec^2" % (
-                           shaper.name, round(shaper.max_accel / 100.) * 100.))
-            all_shapers.append(shaper)
+        for shaper in shapers:
             if (best_shaper is None or shaper.score * 1.2 < best_shaper.score or
                     (shaper.score * 1.05 < best_shaper.score and
                         shaper.smoothing * 1.1 < best_shaper.smoothing)):
                 # Either the shaper significantly improves the score (by 20%),
                 # or it improves the score and smoothing (by 5% and 10% resp.)
                 best_shaper = shaper
-        return best_shaper, all_shapers
+        return best_shaper
+
+    def find_best_shapers(self, datasets, max_smoothing, loggers):
+        # Fit all shapers for a list of calibration data concurrently
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in AUTOTUNE_SHAPERS]
+        jobs = [(self.fit_shaper, (shaper_cfg, data, max_smoothing))
+                for data in datasets for shaper_cfg in shaper_cfgs]
+        def note_result(index, shaper):
+            logger = loggers[index // len(shaper_cfgs)]
+            if logger is None:
+                return
+            logger("Fitted shaper '%s' frequency = %.1f Hz "
+                   "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
+                       shaper.name, shaper.freq, shaper.vibrs * 100.,
+                       shaper.smoothing))
+            logger("To avoid too much smoothing with '%s', suggested "
+                   "max_accel <= %.0f mm/sec^2" % (
+                       shaper.name, round(shaper.max_accel / 100.) * 100.))
+        shapers = self.background_process_exec_many(jobs, note_result)
+        res = []
+        for i in range(len(datasets)):
+            all_shapers = shapers[i*len(shaper_cfgs):(i+1)*len(shaper_cfgs)]
+            res.append((self._select_best_shaper(all_shapers), all_shapers))
+        return res
+
+    def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
+        return self.find_best_shapers([calibration_data], max_smoothing,
+                                      [logger])[0]
 
     def save_params(self, configfile, axis, shaper_name, shaper_freq):
         if axis == 'xy':
@@ -3,9 +3,11 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, mmap, logging
+from . import preparsed_gcode
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+READ_SIZE = 65536
 
 class VirtualSD:
     def __init__(self, config):
@@ -14,7 +16,7 @@ class VirtualSD:
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
-        self.current_file = None
+        self.current_file = self.file_map = self.preparsed_file = None
         self.file_position = self.file_size = 0
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
@@ -41,8 +43,10 @@ class VirtualSD:
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
-                self.current_file.seek(readpos)
-                data = self.current_file.read(readcount + 128)
+                data = b""
+                if self.file_map is not None:
+                    data = self.file_map[readpos:readpos + readcount + 128]
+                data = data.decode('utf-8', 'replace')
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
@@ -111,18 +115,25 @@ class VirtualSD:
     def do_cancel(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
             self.print_stats.note_cancel()
         self.file_position = self.file_size = 0.
+    def _close_file(self):
+        if self.file_map is not None:
+            self.file_map.close()
+            self.file_map = None
+        self.current_file.close()
+        self.current_file = None
+        if self.preparsed_file is not None:
+            self.preparsed_file.close()
+            self.preparsed_file = None
     # G-Code commands
     def cmd_error(self, gcmd):
         raise gcmd.error("SD write not supported")
     def _reset_file(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
         self.file_position = self.file_size = 0.
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -177,16 +188,23 @@ class VirtualSD:
             if fname not in flist:
                 fname = files_by_lower[fname.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
-            f = open(fname, 'r')
+            f = open(fname, 'rb')
             f.seek(0, os.SEEK_END)
             fsize = f.tell()
             f.seek(0)
+            fmap = None
+            if fsize:
+                fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
         self.current_file = f
+        self.file_map = fmap
+        self.preparsed_file = preparsed_gcode.open_preparsed(fname)
+        if self.preparsed_file is not None:
+            logging.info("Using pre-parsed version of %s", fname)
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
@@ -216,38 +234,75 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
+    def _get_commandline(self):
+        # Return the original text of the pre-parsed line being run
+        start, end = self.file_position, self.next_file_position - 1
+        pos = max(self.file_map.rfind(b'\n', start, end) + 1, start)
+        return self.file_map[pos:end].decode('utf-8', 'replace').strip()
+    def _dispatch_lines(self, lines, preparsed, gcode_mutex):
+        # Run queued commands (with the gcode mutex held) until another
+        # task requests the mutex or a new file position is requested
+        get_commandline = self._get_commandline
+        while lines and not self.must_pause_work:
+            line = lines.pop()
+            if preparsed is not None:
+                size, cmd, line = line
+            else:
+                size, cmd = len(line) + 1, None
+                line = line.decode('utf-8', 'replace')
+            next_file_position = self.file_position + size
+            self.next_file_position = next_file_position
+            if cmd is not None:
+                self.gcode.run_move_from_command(cmd, line, get_commandline)
+            else:
+                self.gcode.run_script_from_command(line)
+            self.file_position = self.next_file_position
+            if self.next_file_position != next_file_position:
+                return True
+            if gcode_mutex.has_waiters():
+                break
+        return False
+    def _read_lines(self, pos):
+        # Return the next block of complete lines (as bytes) starting
+        # at the given file position
+        fmap = self.file_map
+        if fmap is None or pos >= len(fmap):
+            return []
+        end = fmap.find(b'\n', min(pos + READ_SIZE, len(fmap)))
+        if end < 0:
+            end = fmap.rfind(b'\n', pos)
+            if end < 0:
+                return []
+        return fmap[pos:end].split(b'\n')
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            logging.exception("virtual_sdcard seek")
-            self.work_timer = None
-            return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
+        preparsed = self.preparsed_file
+        if preparsed is not None and not preparsed.seek(self.file_position):
+            logging.info("Position %d not found in pre-parsed file",
+                         self.file_position)
+            preparsed = None
         lines = []
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    if preparsed is not None:
+                        lines = preparsed.read_records()
+                    else:
+                        lines = self._read_lines(self.file_position)
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if not lines:
                     # End of file
-                    self.current_file.close()
-                    self.current_file = None
+                    self._close_file()
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
                 lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
@@ -255,13 +310,12 @@ class VirtualSD:
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
-            line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                with gcode_mutex:
+                    need_seek = self._dispatch_lines(lines, preparsed,
+                                                     gcode_mutex)
             except self.gcode.error as e:
                 error_message = str(e)
                 break
@@ -269,17 +323,14 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
-                try:
-                    self.current_file.seek(self.file_position)
-                except:
-                    logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
-                    return self.reactor.NEVER
+            if need_seek:
+                if (preparsed is not None
+                    and not preparsed.seek(self.file_position)):
+                    logging.info("Position %d not found in pre-parsed file",
+                                 self.file_position)
+                    preparsed = None
                 lines = []
-                partial_input = ""
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -10,6 +10,23 @@ class CommandError(Exception):
 
 Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
 
+# Parse a plain motion line (eg, "G1 X10 E.2") into a command and a
+# dictionary of float parameters - returns None for any other line
+move_r = re.compile(r'^[gG][0-3](?:\s+[A-Za-z][-+]?[0-9.]+)*$')
+def parse_move_line(line):
+    if move_r.match(line) is None:
+        return None
+    parts = line.split()
+    try:
+        params = { p[0].upper(): float(p[1:]) for p in parts[1:] }
+    except ValueError as e:
+        return None
+    return parts[0].upper(), params
+
+def format_move_line(cmd, params):
+    return " ".join([cmd] + ["%s%.17g" % (p, v)
+                             for p, v in sorted(params.items())])
+
 class GCodeCommand:
     error = CommandError
     def __init__(self, gcode, command, commandline, params, need_ack):
@@ -88,6 +105,7 @@ class GCodeDispatch:
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
+        self.move_handlers = {}
         self.gcode_help = {}
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
@@ -106,6 +124,7 @@ class GCodeDispatch:
             return False
     def register_command(self, cmd, func, when_not_ready=False, desc=None):
         if func is None:
+            self.move_handlers.pop(cmd, None)
             old_cmd = self.ready_gcode_handlers.get(cmd)
             if cmd in self.ready_gcode_handlers:
                 del self.ready_gcode_handlers[cmd]
@@ -123,6 +142,16 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_move_handler(self, cmd, func):
+        # Register a handler for plain motion lines (eg, "G1 X10 E.2").
+        # The handler is invoked with a dictionary of pre-parsed float
+        # parameters and is only used while the regular handler of the
+        # command is still active.
+        handler = self.ready_gcode_handlers.get(cmd)
+        if handler is None:
+            raise self.printer.config_error(
+                "gcode command %s not registered" % (cmd,))
+        self.move_handlers[cmd] = (handler, func)
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -156,13 +185,48 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def get_move_handler(self, cmd):
+        # Return the fast handler of a motion command (or None if the
+        # regular handler of the command has been replaced)
+        mh = self.move_handlers.get(cmd)
+        if mh is None or self.gcode_handlers.get(cmd) is not mh[0]:
+            return None
+        return mh[1]
+    def _parse_move(self, line):
+        # Fast path for plain motion lines - returns None if the line
+        # must be handled by the generic parser
+        move = parse_move_line(line)
+        if move is None:
+            return None
+        cmd, params = move
+        move_handler = self.get_move_handler(cmd)
+        if move_handler is None:
+            return None
+        return cmd, move_handler, params
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
-                line = line[:cpos]
+                line = line[:cpos].rstrip()
+            # Check for a plain motion command with a fast handler
+            move = self._parse_move(line)
+            if move is not None:
+                cmd, move_handler, params = move
+                try:
+                    move_handler(params, origline)
+                except self.error as e:
+                    self._respond_command_error(e)
+                    if not need_ack:
+                        raise
+                except:
+                    self._respond_internal_error(cmd)
+                    if not need_ack:
+                        raise
+                if need_ack:
+                    self.respond_raw("ok")
+                continue
             # Break line into parts and determine command
             parts = self.args_r.split(line.upper())
             numparts = len(parts)
@@ -181,18 +245,47 @@ class GCodeDispatch:
             try:
                 handler(gcmd)
             except self.error as e:
-                self._respond_error(str(e))
-                self.printer.send_event("gcode:command_error")
+                self._respond_command_error(e)
                 if not need_ack:
                     raise
             except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self._respond_error(msg)
+                self._respond_internal_error(cmd)
                 if not need_ack:
                     raise
             gcmd.ack()
+    def _respond_command_error(self, e):
+        self._respond_error(str(e))
+        self.printer.send_event("gcode:command_error")
+    def _respond_internal_error(self, cmd):
+        msg = 'Internal error on command:"%s"' % (cmd,)
+        logging.exception(msg)
+        self.printer.invoke_shutdown(msg)
+        self._respond_error(msg)
+    def run_move_from_command(self, cmd, params, get_commandline=None):
+        # Run a pre-parsed motion command.  The optional get_commandline
+        # callback returns the original text of the line - it is only
+        # invoked when that text is needed.
+        move_handler = self.get_move_handler(cmd)
+        if move_handler is None:
+            if get_commandline is not None:
+                line = get_commandline()
+            else:
+                line = format_move_line(cmd, params)
+            self._process_commands([line], need_ack=False)
+            return
+        try:
+            move_handler(params, cmd)
+        except self.error as e:
+            if get_commandline is not None:
+                e = self.error("%s\nLine: %s" % (e, get_commandline()))
+            self._respond_command_error(e)
+            raise e
+        except:
+            self._respond_internal_error(cmd)
+            raise
+    def run_move(self, cmd, params, get_commandline=None):
+        with self.mutex:
+            self.run_move_from_command(cmd, params, get_commandline)
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
     def run_script(self, script):
@@ -187,6 +187,8 @@ class Printer:
                 if self.state_message is not message_ready:
                     return
                 cb()
+            # Long-lived objects no longer need to be garbage collected
+            self.reactor.freeze_gc()
         except Exception as e:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s"
@@ -237,8 +239,9 @@ class Printer:
                 cb()
             except:
                 logging.exception("Exception during shutdown handler")
-        logging.info("Reactor garbage collection: %s",
-                     self.reactor.get_gc_stats())
+        logging.info("Reactor garbage collection: %s (max pauses %s)",
+                     self.reactor.get_gc_stats(),
+                     self.reactor.get_gc_pause_stats())
     def invoke_async_shutdown(self, msg):
         self.reactor.register_async_callback(
             (lambda e: self.invoke_shutdown(msg)))
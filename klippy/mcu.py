@@ -513,8 +513,8 @@ class CommandWrapper:
             cmd_queue = serial.get_default_command_queue()
         self._cmd_queue = cmd_queue
     def send(self, data=(), minclock=0, reqclock=0):
-        cmd = self._cmd.encode(data)
-        self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+        self._serial.raw_send_params(self._cmd, data, minclock, reqclock,
+                                     self._cmd_queue)
 
 class MCU:
     error = error
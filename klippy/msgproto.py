@@ -41,6 +41,7 @@ class PT_uint32:
     is_dynamic_string = False
     max_length = 5
     signed = False
+    c_type = 'u'
     def encode(self, out, v):
         if v >= 0xc000000 or v < -0x4000000: out.append((v>>28) & 0x7f | 0x80)
         if v >= 0x180000 or v < -0x80000:    out.append((v>>21) & 0x7f | 0x80)
@@ -63,6 +64,7 @@ class PT_uint32:
 
 class PT_int32(PT_uint32):
     signed = True
+    c_type = 'i'
 class PT_uint16(PT_uint32):
     max_length = 3
 class PT_int16(PT_int32):
@@ -75,6 +77,7 @@ class PT_string:
     is_int = False
     is_dynamic_string = True
     max_length = 64
+    c_type = 's'
     def encode(self, out, v):
         out.append(len(v))
         out.extend(bytearray(v))
@@ -101,20 +104,25 @@ class Enumeration:
     def __init__(self, pt, enum_name, enums):
         self.pt = pt
         self.max_length = pt.max_length
+        self.c_type = pt.c_type
         self.enum_name = enum_name
         self.enums = enums
         self.reverse_enums = {v: k for k, v in enums.items()}
-    def encode(self, out, v):
+    def lookup_value(self, v):
         tv = self.enums.get(v)
         if tv is None:
             raise enumeration_error(self.enum_name, v)
-        self.pt.encode(out, tv)
-    def parse(self, s, pos):
-        v, pos = self.pt.parse(s, pos)
+        return tv
+    def lookup_name(self, v):
         tv = self.reverse_enums.get(v)
         if tv is None:
             tv = "?%d" % (v,)
-        return tv, pos
+        return tv
+    def encode(self, out, v):
+        self.pt.encode(out, self.lookup_value(v))
+    def parse(self, s, pos):
+        v, pos = self.pt.parse(s, pos)
+        return self.lookup_name(v), pos
 
 MessageTypes = {
     '%u': PT_uint32(), '%i': PT_int32(),
@@ -170,6 +178,10 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        # Parameter types for the C helper encoder and parser
+        self.c_types = ''.join([t.c_type for t in self.param_types]).encode()
+        self.is_int_only = all([t.is_int for t in self.param_types])
+        self.c_names = [name for name, t in self.param_names]
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -189,6 +201,37 @@ class MessageFormat:
             v, pos = t.parse(s, pos)
             out[name] = v
         return out, pos
+    def get_c_params(self, params):
+        # Convert parameters to the ints and buffers used by the C encoder
+        if len(params) < len(self.param_types):
+            raise error("Missing parameters for '%s'" % (self.name,))
+        if self.is_int_only:
+            return params, b""
+        ints = []
+        bufs = []
+        for t, v in zip(self.param_types, params):
+            if t.is_dynamic_string:
+                v = bytes(bytearray(v))
+                bufs.append(v)
+                v = len(v)
+            elif not t.is_int:
+                v = t.lookup_value(v)
+            ints.append(v)
+        return ints, b"".join(bufs)
+    def parse_c_params(self, vals, pos, msgdata):
+        # Build the parameters from the values returned by the C parser
+        # (msgdata is a bytearray containing the received message)
+        end = pos + len(self.param_types)
+        if self.is_int_only:
+            return dict(zip(self.c_names, vals[pos:end])), end
+        out = {}
+        for (name, t), v in zip(self.param_names, vals[pos:end]):
+            if t.is_dynamic_string:
+                v = bytes(msgdata[v:v+msgdata[v-1]])
+            elif not t.is_int:
+                v = t.lookup_name(v)
+            out[name] = v
+        return out, end
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -200,6 +243,7 @@ class MessageFormat:
 
 class OutputFormat:
     name = '#output'
+    c_types = None
     def __init__(self, msgid, msgformat):
         self.msgid = msgid
         self.msgformat = msgformat
@@ -220,6 +264,7 @@ class OutputFormat:
 
 class UnknownFormat:
     name = '#unknown'
+    c_types = None
     def parse(self, s, pos):
         msgid = s[pos]
         msg = bytes(bytearray(s))
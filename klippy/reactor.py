@@ -3,17 +3,28 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq, bisect
 import greenlet
 import chelper, util
 
 _NOW = 0.
 _NEVER = 9999999999999999.
 
+# Garbage collections must be expected to complete in this fraction of
+# the time available before the gc deadline timer
+GC_SLACK_FRACTION = 0.5
+GC_ESTIMATE_DECAY = 0.9
+# A deferred collection runs anyway after this many deferrals in a row
+GC_MAX_DEFERRALS = 20
+GC_LOG_TIME = 0.005
+
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.is_registered = True
+        self.heap_entry = None
+        self.run_pass = 0
 
 class ReactorCompletion:
     class sentinel: pass
@@ -60,6 +71,7 @@ class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
+        self.profile_owner = None
 
 class ReactorMutex:
     def __init__(self, reactor, is_locked):
@@ -71,6 +83,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return bool(self.queue)
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -90,6 +104,132 @@ class ReactorMutex:
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+# Return the name of the module that owns a callback
+def get_callback_owner(callback):
+    obj = getattr(callback, '__self__', None)
+    if isinstance(obj, ReactorGreenlet):
+        # Greenlet wakeup from pause() - use the paused callback's owner
+        if obj.profile_owner is not None:
+            return obj.profile_owner
+        return 'reactor'
+    if obj is not None:
+        module = type(obj).__module__
+    else:
+        module = getattr(callback, '__module__', None)
+        if module is None:
+            module = type(callback).__module__
+    if module.startswith('extras.'):
+        module = module[7:]
+    return module
+
+# Upper limits of the late timer wakeup histogram buckets
+LATE_BUCKETS = [.001, .005, .010, .025, .050, .100, .250]
+STALL_COUNT = 10
+
+# Optional tracking of the time spent in timer and fd callbacks
+class ReactorProfiler:
+    def __init__(self, reactor):
+        self.monotonic = reactor.monotonic
+        self.start_time = self.active_start = self.monotonic()
+        self.active = None
+        # Cumulative stats
+        self.owners = {}
+        self.late_counts = [0] * (len(LATE_BUCKETS) + 1)
+        self.max_late = (0., None)
+        self.stalls = []
+        # Stats since the last call to get_interval_stats()
+        self.interval_busy = self.interval_late = 0.
+        self.interval_late_owner = None
+        self.interval_stall = 0.
+        self.interval_stall_owner = None
+    def _get_owner_stats(self, owner):
+        ostats = self.owners.get(owner)
+        if ostats is None:
+            # [timer calls, fd calls, total time, longest time]
+            ostats = self.owners[owner] = [0, 0, 0., 0.]
+        return ostats
+    def _charge(self, now):
+        # Account the time since the last transition to the active owner
+        owner = self.active
+        if owner is not None:
+            duration = now - self.active_start
+            ostats = self._get_owner_stats(owner)
+            ostats[2] += duration
+            ostats[3] = max(ostats[3], duration)
+            self.interval_busy += duration
+            if duration > self.interval_stall:
+                self.interval_stall = duration
+                self.interval_stall_owner = owner
+            stalls = self.stalls
+            if len(stalls) < STALL_COUNT or duration > stalls[0][0]:
+                bisect.insort(stalls, (duration, owner, self.active_start))
+                if len(stalls) > STALL_COUNT:
+                    del stalls[0]
+        self.active_start = now
+    def _start(self, owner):
+        now = self.monotonic()
+        self._charge(now)
+        prev_owner = self.active
+        self.active = greenlet.getcurrent().profile_owner = owner
+        return now, prev_owner
+    def _stop(self, prev_owner):
+        self._charge(self.monotonic())
+        self.active = greenlet.getcurrent().profile_owner = prev_owner
+    def suspend(self):
+        # The dispatch greenlet is pausing
+        self._charge(self.monotonic())
+        self.active = None
+    def resume(self):
+        # A paused greenlet is running again
+        self._charge(self.monotonic())
+        self.active = getattr(greenlet.getcurrent(), 'profile_owner', None)
+    def run_timer(self, callback, waketime, eventtime):
+        owner = get_callback_owner(callback)
+        now, prev_owner = self._start(owner)
+        self._get_owner_stats(owner)[0] += 1
+        if waketime > _NOW:
+            late = now - waketime
+            self.late_counts[bisect.bisect(LATE_BUCKETS, late)] += 1
+            if late > self.max_late[0]:
+                self.max_late = (late, owner)
+            if late > self.interval_late:
+                self.interval_late = late
+                self.interval_late_owner = owner
+        try:
+            return callback(eventtime)
+        finally:
+            self._stop(prev_owner)
+    def run_fd(self, callback, eventtime):
+        owner = get_callback_owner(callback)
+        now, prev_owner = self._start(owner)
+        self._get_owner_stats(owner)[1] += 1
+        try:
+            callback(eventtime)
+        finally:
+            self._stop(prev_owner)
+    def get_interval_stats(self):
+        res = {'busy': self.interval_busy,
+               'max_late': self.interval_late,
+               'max_late_owner': self.interval_late_owner,
+               'max_stall': self.interval_stall,
+               'max_stall_owner': self.interval_stall_owner}
+        self.interval_busy = self.interval_late = self.interval_stall = 0.
+        self.interval_late_owner = self.interval_stall_owner = None
+        return res
+    def get_stats(self):
+        callbacks = {
+            owner: {'timer_calls': tcalls, 'fd_calls': fcalls,
+                    'total_time': total, 'max_time': max_time}
+            for owner, (tcalls, fcalls, total, max_time) in self.owners.items()}
+        late_names = ["<%.3f" % (l,) for l in LATE_BUCKETS]
+        late_names.append(">=%.3f" % (LATE_BUCKETS[-1],))
+        return {
+            'start_time': self.start_time, 'callbacks': callbacks,
+            'late_wakeups': dict(zip(late_names, self.late_counts)),
+            'max_late': self.max_late[0], 'max_late_owner': self.max_late[1],
+            'stalls': [{'duration': d, 'owner': o, 'eventtime': t}
+                       for d, o, t in reversed(self.stalls)]}
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -100,8 +240,19 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        self._gc_estimates = [0., 0., 0.]
+        self._gc_deferrals = [0, 0, 0]
+        self._gc_max_pauses = [0., 0., 0.]
+        self._gc_deadline_timer = None
+        # Callback profiling
+        self._profiler = None
+        # Timers (a heap of [waketime, sequence, timer] entries - an entry
+        # is cancelled by clearing its timer)
+        self._timer_heap = []
+        self._timer_count = 0
+        self._timer_seq = 0
+        self._timer_pass = 0
+        self._deferred_timers = []
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -114,22 +265,96 @@ class SelectReactor:
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_gc_pause_stats(self):
+        return tuple(self._gc_max_pauses)
+    def set_gc_deadline_timer(self, timer_handler):
+        # Only run a garbage collection if it is expected to complete
+        # well before this timer is due
+        self._gc_deadline_timer = timer_handler
+    def freeze_gc(self):
+        # Exclude all existing objects from future garbage collections
+        if not self._check_gc or not hasattr(gc, 'freeze'):
+            return
+        start_time = self.monotonic()
+        gc.collect()
+        gc.freeze()
+        logging.info("Froze %d objects for garbage collection (%.3fs)",
+                     gc.get_freeze_count(), self.monotonic() - start_time)
+    def _collect_garbage(self, eventtime, gi):
+        gc_level = 0
+        if gi[1] >= 10:
+            gc_level = 1
+            if gi[2] >= 10:
+                gc_level = 2
+        # Defer the more expensive collections if they may not complete
+        # before the deadline (a young generation collection always runs).
+        # The estimate decays on each deferral (it is only remeasured when
+        # the collection runs) and a collection is not deferred forever.
+        if self._gc_deadline_timer is not None:
+            slack = self._gc_deadline_timer.waketime - eventtime
+            max_pause = slack * GC_SLACK_FRACTION
+            while (gc_level and self._gc_estimates[gc_level] > max_pause
+                   and self._gc_deferrals[gc_level] < GC_MAX_DEFERRALS):
+                self._gc_deferrals[gc_level] += 1
+                self._gc_estimates[gc_level] *= GC_ESTIMATE_DECAY
+                gc_level -= 1
+        for i in range(gc_level + 1):
+            self._gc_deferrals[i] = 0
+        self._last_gc_times[gc_level] = eventtime
+        start_time = self.monotonic()
+        gc.collect(gc_level)
+        pause = self.monotonic() - start_time
+        self._gc_estimates[gc_level] = max(
+            pause, self._gc_estimates[gc_level] * GC_ESTIMATE_DECAY)
+        self._gc_max_pauses[gc_level] = max(self._gc_max_pauses[gc_level],
+                                            pause)
+        if gc_level == 2 or pause >= GC_LOG_TIME:
+            logging.info("Garbage collection gen%d took %.6fs",
+                         gc_level, pause)
+        else:
+            logging.debug("Garbage collection gen%d took %.6fs",
+                          gc_level, pause)
+    # Profiling
+    def setup_profiler(self):
+        if self._profiler is None:
+            self._profiler = ReactorProfiler(self)
+        return self._profiler
     # Timers
+    def _schedule_timer(self, timer_handler, waketime):
+        entry = timer_handler.heap_entry
+        if entry is not None:
+            if entry[0] == waketime:
+                return
+            entry[2] = timer_handler.heap_entry = None
+        if waketime >= self.NEVER:
+            return
+        self._timer_seq += 1
+        entry = timer_handler.heap_entry = [
+            waketime, self._timer_seq, timer_handler]
+        heap = self._timer_heap
+        heapq.heappush(heap, entry)
+        if len(heap) > 2 * self._timer_count + 64:
+            # Discard cancelled entries
+            heap[:] = [e for e in heap if e[2] is not None]
+            heapq.heapify(heap)
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        if timer_handler.is_registered:
+            self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if not timer_handler.is_registered:
+            raise ValueError("Timer not registered")
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.is_registered = False
+        self._timer_count -= 1
+        self._schedule_timer(timer_handler, self.NEVER)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -138,27 +363,46 @@ class SelectReactor:
                 gi = gc.get_count()
                 if gi[0] >= 700:
                     # Reactor looks idle and gc is due - run it
-                    gc_level = 0
-                    if gi[1] >= 10:
-                        gc_level = 1
-                        if gi[2] >= 10:
-                            gc_level = 2
-                    self._last_gc_times[gc_level] = eventtime
-                    gc.collect(gc_level)
+                    self._collect_garbage(eventtime, gi)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        profiler = self._profiler
+        heap = self._timer_heap
+        # Timers are only run once per pass - requeue any timers that
+        # became ready again during the last pass
+        for entry in self._deferred_timers:
+            if entry[2] is not None:
+                heapq.heappush(heap, entry)
+        self._deferred_timers = []
+        self._timer_pass = run_pass = self._timer_pass + 1
+        while heap and heap[0][0] <= eventtime:
+            entry = heapq.heappop(heap)
+            t = entry[2]
+            if t is None:
+                continue
+            if t.run_pass == run_pass:
+                self._deferred_timers.append(entry)
+                continue
+            t.run_pass = run_pass
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            if profiler is None:
+                waketime = t.callback(eventtime)
+            else:
+                waketime = profiler.run_timer(t.callback, entry[0], eventtime)
+            t.waketime = waketime
+            if t.is_registered:
+                self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._next_timer = min(self._next_timer, waketime)
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if self._deferred_timers:
+            self._next_timer = self.NOW
+        elif heap:
+            self._next_timer = min(self._next_timer, heap[0][0])
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -209,7 +453,10 @@ class SelectReactor:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
             # Switch to _check_timers (via g.timer.callback return)
-            return self._g_dispatch.switch(waketime)
+            eventtime = self._g_dispatch.switch(waketime)
+            if self._profiler is not None:
+                self._profiler.resume()
+            return eventtime
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
         if self._greenlets:
             g_next = self._greenlets.pop()
@@ -219,9 +466,13 @@ class SelectReactor:
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
+        if self._profiler is not None:
+            self._profiler.suspend()
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
+        if self._profiler is not None:
+            self._profiler.resume()
         return eventtime
     def _end_greenlet(self, g_old):
         # Cache this greenlet for later use
@@ -254,7 +505,10 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.callback(eventtime)
+                if self._profiler is None:
+                    fd.callback(eventtime)
+                else:
+                    self._profiler.run_fd(fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -282,6 +536,8 @@ class SelectReactor:
             os.close(self._pipe_fds[0])
             os.close(self._pipe_fds[1])
             self._pipe_fds = None
+        if self._check_gc and hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
 
 class PollReactor(SelectReactor):
     def __init__(self, gc_checking=False):
@@ -313,7 +569,10 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -350,7 +609,10 @@ class EPollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, os
 import serial
 
 import msgproto, chelper, util
@@ -24,9 +24,14 @@ class SerialReader:
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
-        # Threading
-        self.lock = threading.Lock()
-        self.background_thread = None
+        # Receive handling
+        self.receive_fd = None
+        self.receive_fd_handle = None
+        self.receive_buf = self.ffi_main.new('struct pull_queue_message[64]')
+        self.receive_vals = self.ffi_main.new('int64_t[%d]' % (
+            len(self.receive_buf) * (msgproto.MESSAGE_PAYLOAD_MAX + 1),))
+        self.c_formats = self.c_formats_data = None
+        self._setup_c_formats()
         # Message handlers
         self.handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
@@ -34,30 +39,70 @@ class SerialReader:
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
-    def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
-        while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count < 0:
-                break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
+    def _setup_c_formats(self):
+        # Export the response parameter types to the C helper parser
+        self.c_formats = self.ffi_main.new('char *[%d]' % (
+            self.ffi_lib.MSGBLOCK_MAX_MSGID,))
+        self.c_formats_data = []
+        for msgid, mid in self.msgparser.messages_by_id.items():
+            if mid.c_types is None or msgid >= len(self.c_formats):
                 continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
+            c_types = self.ffi_main.new('char[]', mid.c_types)
+            self.c_formats_data.append(c_types)
+            self.c_formats[msgid] = c_types
+    def _process_responses(self, eventtime):
+        # Dispatch all messages received by the serialqueue background thread
+        try:
+            os.read(self.receive_fd, 4096)
+        except os.error:
+            pass
+        buf = self.receive_buf
+        buf_len = len(buf)
+        c_vals = self.receive_vals
+        pull_batch = self.ffi_lib.serialqueue_pull_batch
+        parse_batch = self.ffi_lib.msgblock_parse_batch
+        unpack = self.ffi_main.unpack
+        ffi_buffer = self.ffi_main.buffer
+        handlers = self.handlers
+        pending_notifications = self.pending_notifications
+        while 1:
+            count = pull_batch(self.serialqueue, buf, buf_len)
+            msgparser = self.msgparser
+            messages_by_id = msgparser.messages_by_id
+            vals = unpack(c_vals, parse_batch(self.c_formats, buf, count,
+                                              c_vals))
+            pos = 0
+            for i in range(count):
+                response = buf[i]
+                msgid = vals[pos]
+                pos += 1
+                if response.notify_id:
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    completion = pending_notifications.pop(response.notify_id)
+                    completion.complete(params)
+                    continue
+                if msgid < 0:
+                    params = msgparser.parse(response.msg[0:response.len])
+                else:
+                    mid = messages_by_id[msgid]
+                    msgdata = None
+                    if not mid.is_int_only:
+                        msgdata = bytearray(ffi_buffer(response.msg,
+                                                       response.len))
+                    params, pos = mid.parse_c_params(vals, pos, msgdata)
+                    params['#name'] = mid.name
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                hdl = (params['#name'], params.get('oid'))
+                try:
+                    hdl = handlers.get(hdl, self.handle_default)
                     hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+                except:
+                    logging.exception("%sException in serial callback",
+                                      self.warn_prefix)
+            if count < buf_len:
+                break
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -83,8 +128,10 @@ class SerialReader:
             self.ffi_lib.serialqueue_alloc(serial_dev.fileno(),
                                            serial_fd_type, client_id),
             self.ffi_lib.serialqueue_free)
-        self.background_thread = threading.Thread(target=self._bg_thread)
-        self.background_thread.start()
+        self.receive_fd = self.ffi_lib.serialqueue_get_receive_fd(
+            self.serialqueue)
+        self.receive_fd_handle = self.reactor.register_fd(
+            self.receive_fd, self._process_responses)
         # Obtain and load the data dictionary from the firmware
         completion = self.reactor.register_callback(self._get_identify_data)
         identify_data = completion.wait(self.reactor.monotonic() + 5.)
@@ -95,6 +142,7 @@ class SerialReader:
         msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self._setup_c_formats()
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         mcu_baud = msgparser.get_constant_float('SERIAL_BAUD', None)
@@ -197,6 +245,7 @@ class SerialReader:
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.serial_dev = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
+        self._setup_c_formats()
         self.serialqueue = self.ffi_main.gc(
             self.ffi_lib.serialqueue_alloc(self.serial_dev.fileno(), b'f', 0),
             self.ffi_lib.serialqueue_free)
@@ -206,9 +255,12 @@ class SerialReader:
     def disconnect(self):
         if self.serialqueue is not None:
             self.ffi_lib.serialqueue_exit(self.serialqueue)
-            if self.background_thread is not None:
-                self.background_thread.join()
-            self.background_thread = self.serialqueue = None
+            if self.receive_fd_handle is not None:
+                # Dispatch any messages still in the receive queue
+                self.reactor.unregister_fd(self.receive_fd_handle)
+                self._process_responses(self.reactor.monotonic())
+            self.receive_fd = self.receive_fd_handle = None
+            self.serialqueue = None
         if self.serial_dev is not None:
             self.serial_dev.close()
             self.serial_dev = None
@@ -229,15 +281,23 @@ class SerialReader:
         return self.default_cmd_queue
     # Serial response callbacks
     def register_response(self, callback, name, oid=None):
-        with self.lock:
-            if callback is None:
-                del self.handlers[name, oid]
-            else:
-                self.handlers[name, oid] = callback
+        if callback is None:
+            del self.handlers[name, oid]
+        else:
+            self.handlers[name, oid] = callback
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
+    def raw_send_params(self, msgformat, params, minclock, reqclock,
+                        cmd_queue):
+        # Encode (via the C helper code) and send a command
+        ints, bufs = msgformat.get_c_params(params)
+        ret = self.ffi_lib.serialqueue_send_params(
+            self.serialqueue, cmd_queue, msgformat.c_types, msgformat.msgid,
+            ints, bufs, minclock, reqclock, 0)
+        if ret:
+            self._error("Unable to encode '%s'", msgformat.name)
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
         self.last_notify_id += 1
         nid = self.last_notify_id
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
+import math, logging, importlib, array
 import mcu, chelper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
@@ -12,6 +12,12 @@ import mcu, chelper, kinematics.extruder
 
 # Class to track each move request
 class Move:
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'timing_callbacks', 'is_kinematic_move', 'axes_d', 'axes_r',
+                 'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2',
+                 'delta_v2', 'max_smoothed_v2', 'smooth_delta_v2',
+                 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
@@ -89,33 +95,44 @@ class Move:
         self.max_smoothed_v2 = min(
             self.max_start_v2
             , prev_move.max_smoothed_v2 + prev_move.smooth_delta_v2)
-    def set_junction(self, start_v2, cruise_v2, end_v2):
-        # Determine accel, cruise, and decel portions of the move distance
-        half_inv_accel = .5 / self.accel
-        accel_d = (cruise_v2 - start_v2) * half_inv_accel
-        decel_d = (cruise_v2 - end_v2) * half_inv_accel
-        cruise_d = self.move_d - accel_d - decel_d
-        # Determine move velocities
-        self.start_v = start_v = math.sqrt(start_v2)
-        self.cruise_v = cruise_v = math.sqrt(cruise_v2)
-        self.end_v = end_v = math.sqrt(end_v2)
-        # Determine time spent in each portion of move (time is the
-        # distance divided by average velocity)
-        self.accel_t = accel_d / ((start_v + cruise_v) * 0.5)
-        self.cruise_t = cruise_d / cruise_v
-        self.decel_t = decel_d / ((end_v + cruise_v) * 0.5)
+    def get_lookahead_params(self):
+        # Parameters in the layout of the C 'struct lookahead_move'
+        return (self.move_d, self.accel,
+                self.max_start_v2, self.max_cruise_v2, self.delta_v2,
+                self.max_smoothed_v2, self.smooth_delta_v2,
+                0., 0., 0., 0., 0., 0.)
+    def set_junction(self, params):
+        # Store velocities and timing calculated by lookahead_flush()
+        (self.start_v, self.cruise_v, self.end_v,
+         self.accel_t, self.cruise_t, self.decel_t) = params
+    def get_trapq_params(self):
+        # Parameters in the layout of the C 'struct trapq_batch_move'
+        return ((self.is_kinematic_move, self.accel_t, self.cruise_t,
+                 self.decel_t, self.start_v, self.cruise_v, self.accel)
+                + self.start_pos + tuple(self.axes_r))
 
 LOOKAHEAD_FLUSH_TIME = 0.250
 
+# Layout of the C 'struct lookahead_move' (as an array of doubles)
+LOOKAHEAD_PARAMS = 13
+LOOKAHEAD_START_V = 7
+
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        # Lookahead parameters of each queued move (as an array of
+        # 'struct lookahead_move') for use by the C lookahead code
+        self.lookahead = array.array('d')
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.ffi_from_buffer = ffi_main.from_buffer
+        self.lookahead_flush = ffi_lib.lookahead_flush
     def reset(self):
         del self.queue[:]
+        del self.lookahead[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
@@ -125,61 +142,30 @@ class MoveQueue:
         return None
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
-        update_flush_count = lazy
         queue = self.queue
-        flush_count = len(queue)
-        # Traverse queue from last to first move and determine maximum
-        # junction speed assuming the robot comes to a complete stop
-        # after the last move.
-        delayed = []
-        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
-        for i in range(flush_count-1, -1, -1):
-            move = queue[i]
-            reachable_start_v2 = next_end_v2 + move.delta_v2
-            start_v2 = min(move.max_start_v2, reachable_start_v2)
-            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
-            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
-            if smoothed_v2 < reachable_smoothed_v2:
-                # It's possible for this move to accelerate
-                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
-                    or delayed):
-                    # This move can decelerate or this is a full accel
-                    # move after a full decel move
-                    if update_flush_count and peak_cruise_v2:
-                        flush_count = i
-                        update_flush_count = False
-                    peak_cruise_v2 = min(move.max_cruise_v2, (
-                        smoothed_v2 + reachable_smoothed_v2) * .5)
-                    if delayed:
-                        # Propagate peak_cruise_v2 to any delayed moves
-                        if not update_flush_count and i < flush_count:
-                            mc_v2 = peak_cruise_v2
-                            for m, ms_v2, me_v2 in reversed(delayed):
-                                mc_v2 = min(mc_v2, ms_v2)
-                                m.set_junction(min(ms_v2, mc_v2), mc_v2
-                                               , min(me_v2, mc_v2))
-                        del delayed[:]
-                if not update_flush_count and i < flush_count:
-                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
-                                    , move.max_cruise_v2, peak_cruise_v2)
-                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
-                                      , min(next_end_v2, cruise_v2))
-            else:
-                # Delay calculating this move until peak_cruise_v2 is known
-                delayed.append((move, start_v2, next_end_v2))
-            next_end_v2 = start_v2
-            next_smoothed_v2 = smoothed_v2
-        if update_flush_count or not flush_count:
+        lookahead = self.lookahead
+        # Determine the maximum junction speeds of the queued moves
+        flush_count = self.lookahead_flush(
+            self.ffi_from_buffer('struct lookahead_move[]', lookahead),
+            len(queue), lazy)
+        if not flush_count:
             return
+        pos = LOOKAHEAD_START_V
+        for move in queue[:flush_count]:
+            move.set_junction(lookahead[pos:pos+6])
+            pos += LOOKAHEAD_PARAMS
         # Generate step times for all moves ready to be flushed
         self.toolhead._process_moves(queue[:flush_count])
         # Remove processed moves from the queue
         del queue[:flush_count]
+        del lookahead[:flush_count * LOOKAHEAD_PARAMS]
     def add_move(self, move):
         self.queue.append(move)
+        if len(self.queue) > 1:
+            move.calc_junction(self.queue[-2])
+        self.lookahead.extend(move.get_lookahead_params())
         if len(self.queue) == 1:
             return
-        move.calc_junction(self.queue[-2])
         self.junction_flush -= move.min_move_t
         if self.junction_flush <= 0.:
             # Enough moves have been queued to reach the target flush time.
@@ -232,6 +218,7 @@ class ToolHead:
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
+        self.reactor.set_gc_deadline_timer(self.flush_timer)
         self.move_queue.set_flush_time(self.buffer_time_high)
         self.idle_flush_print_time = 0.
         self.print_stall = 0
@@ -243,8 +230,10 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
+        self.ffi_from_buffer = ffi_main.from_buffer
+        self.trapq_batch = array.array('d')
         self.step_generators = []
         # Create kinematics class
         gcode = self.printer.lookup_object('gcode')
@@ -311,22 +300,25 @@ class ToolHead:
                 self.need_check_stall = -1.
                 self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
             self._calc_print_time()
-        # Queue moves into trapezoid motion queue (trapq)
+        # Queue moves into trapezoid motion queues (trapq)
         next_move_time = self.print_time
+        trapq_batch = self.trapq_batch
+        timing_callbacks = []
         for move in moves:
-            if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
-                    move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
-            if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+            trapq_batch.extend(move.get_trapq_params())
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
+            if move.timing_callbacks:
+                timing_callbacks.append((next_move_time, move.timing_callbacks))
+        extruder_trapq, pressure_advance = self.extruder.get_move_trapq()
+        self.trapq_append_batch(
+            self.trapq, extruder_trapq, self.print_time, pressure_advance,
+            self.ffi_from_buffer('struct trapq_batch_move[]', trapq_batch),
+            len(moves))
+        del trapq_batch[:]
+        for print_time, callbacks in timing_callbacks:
+            for cb in callbacks:
+                cb(print_time)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
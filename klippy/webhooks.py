@@ -3,10 +3,11 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
+import logging, socket, os, sys, errno, json, math, collections
 import gcode
 
 REQUEST_LOG_SIZE = 20
+SEND_HIGH_WATER = 4 * 1024 * 1024
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -26,6 +27,39 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+# NaN and Infinity are not valid json - they are sent as null
+def json_clean_nonfinite(data):
+    if isinstance(data, float):
+        if math.isnan(data) or math.isinf(data):
+            return None
+        return data
+    if isinstance(data, dict):
+        return {k: json_clean_nonfinite(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [json_clean_nonfinite(v) for v in data]
+    return data
+
+def json_encode(data):
+    try:
+        return json.dumps(data, separators=(',', ':'),
+                          allow_nan=False).encode()
+    except ValueError:
+        return json.dumps(json_clean_nonfinite(data),
+                          separators=(',', ':')).encode()
+
+# Use the faster orjson encoder if it is available (it also sends
+# NaN and Infinity as null)
+try:
+    import orjson
+    def json_encode(data, std_json_encode=json_encode):
+        try:
+            return orjson.dumps(data, default=list,
+                                option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return std_json_encode(data)
+except ImportError:
+    pass
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -172,7 +206,8 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_buffer = bytearray()
         self.is_sending_data = False
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
@@ -211,6 +246,11 @@ class ClientConnection:
     def is_closed(self):
         return self.fd_handle is None
 
+    def is_congested(self):
+        # Producers of optional data should drop or coalesce messages
+        # while the client is not keeping up
+        return len(self.send_buffer) > SEND_HIGH_WATER
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -257,8 +297,11 @@ class ClientConnection:
         self.send(result)
 
     def send(self, data):
-        jmsg = json.dumps(data, separators=(',', ':'))
-        self.send_buffer += jmsg.encode() + b"\x03"
+        self.send_encoded(json_encode(data))
+
+    def send_encoded(self, jmsg):
+        self.send_buffer += jmsg
+        self.send_buffer += b"\x03"
         if not self.is_sending_data:
             self.is_sending_data = True
             self.reactor.register_callback(self._do_send)
@@ -279,7 +322,7 @@ class ClientConnection:
                     continue
             retries = 10
             if sent > 0:
-                self.send_buffer = self.send_buffer[sent:]
+                del self.send_buffer[:sent]
             else:
                 logging.info(
                     "webhooks: Error sending server data,  closing socket")
@@ -442,54 +485,97 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.tracked_objects = {}
+        self.coalesced_updates = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
         webhooks.register_endpoint("objects/query", self._handle_query)
         webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
+    def register_status_tracking(self, obj_name):
+        # The get_status() of a registered object is only called again
+        # after the object reports a change via note_status_change()
+        self.tracked_objects[obj_name] = True
+    def note_status_change(self, obj_name):
+        self.tracked_objects[obj_name] = True
     def _handle_list(self, web_request):
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_query):
+        # Returns the object's status and whether it may have changed
+        tracked = self.tracked_objects
+        if tracked.get(obj_name) is False and obj_name in last_query:
+            return last_query[obj_name], False
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}, True
+        if obj_name in tracked:
+            tracked[obj_name] = False
+        return po.get_status(eventtime), True
+    def _coalesce_update(self, cconn, cquery):
+        # Merge status changes for a client that is not keeping up
+        pending = self.coalesced_updates.setdefault(cconn, {})
+        for obj_name, cres in cquery.items():
+            pending.setdefault(obj_name, {}).update(cres)
+        return pending
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
+        changed = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
+        # Clients with identical subscriptions share the encoded update
+        updates = {}
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, tkey in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
                 del self.clients[cconn]
+                self.coalesced_updates.pop(cconn, None)
                 continue
+            if not is_query:
+                key = (tuple(sorted([(n, None if v is None else tuple(v))
+                                     for n, v in subscription.items()])),
+                       tkey)
+                if key in updates:
+                    self._send_update(cconn, send_func, template, eventtime,
+                                      *updates[key])
+                    continue
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res, changed[obj_name] = self._query_object(
+                        obj_name, eventtime, last_query)
+                    query[obj_name] = res
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                if is_query:
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in req_items}
+                    continue
+                if not changed[obj_name]:
+                    continue
                 lres = last_query.get(obj_name, {})
                 cres = {}
                 for ri in req_items:
                     rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
+                    if rd != lres.get(ri):
                         cres[ri] = rd
-                if cres or is_query:
+                if cres:
                     cquery[obj_name] = cres
             # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
+            if is_query:
+                send_func({'params': {'eventtime': eventtime,
+                                      'status': cquery}})
+                continue
+            updates[key] = self._send_update(
+                cconn, send_func, template, eventtime, cquery, None)
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -497,6 +583,29 @@ class QueryStatusHelper:
             self.query_timer = None
             return reactor.NEVER
         return eventtime + SUBSCRIPTION_REFRESH_TIME
+    def _send_update(self, cconn, send_func, template, eventtime,
+                     cquery, jmsg):
+        # Returns the (status, encoded message) that may be shared with
+        # other clients that have an identical subscription
+        if cconn.is_congested():
+            self._coalesce_update(cconn, cquery)
+            return cquery, jmsg
+        status = cquery
+        if cconn in self.coalesced_updates:
+            status = self._coalesce_update(cconn, cquery)
+            del self.coalesced_updates[cconn]
+        elif jmsg is not None:
+            send_func(jmsg)
+            return cquery, jmsg
+        if not status:
+            return cquery, jmsg
+        tmp = dict(template)
+        tmp['params'] = {'eventtime': eventtime, 'status': status}
+        smsg = json_encode(tmp)
+        send_func(smsg)
+        if status is cquery:
+            jmsg = smsg
+        return cquery, jmsg
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -512,9 +621,11 @@ class QueryStatusHelper:
         template = web_request.get_dict('response_template', {})
         if is_subscribe and cconn in self.clients:
             del self.clients[cconn]
+            self.coalesced_updates.pop(cconn, None)
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((None, objects, complete.complete, {},
+                                     None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -523,11 +634,13 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            tkey = json.dumps(template, sort_keys=True)
+            self.clients[cconn] = (cconn, objects, cconn.send_encoded,
+                                   template, tkey)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
 def add_early_printer_objects(printer):
     printer.add_object('webhooks', WebHooks(printer))
     GCodeHelper(printer)
-    QueryStatusHelper(printer)
+    printer.add_object('query_status', QueryStatusHelper(printer))
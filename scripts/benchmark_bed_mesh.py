@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Benchmark bed_mesh interpolation over several probe grid sizes
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, random, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+bed_mesh = importlib.import_module('.bed_mesh', 'extras')
+
+GRID_SIZES = [3, 5, 7, 9, 11, 15]
+
+def time_build(params, z_matrix, count):
+    best = None
+    for i in range(count):
+        mesh = bed_mesh.ZMesh(dict(params))
+        start = time.time()
+        mesh.build_mesh(z_matrix)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--pps", type="int", dest="pps", default=4,
+                    help="mesh points per segment")
+    opts.add_option("-c", "--count", type="int", dest="count", default=5,
+                    help="number of runs per test (best time is reported)")
+    opts.add_option("-n", "--no-numpy", action="store_true", dest="no_numpy",
+                    help="use the pure python interpolation code")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.no_numpy:
+        bed_mesh.numpy = None
+    sys.stdout.write("numpy: %s\n" % (
+        "not used" if bed_mesh.numpy is None else bed_mesh.numpy.__version__))
+    random.seed(0)
+    for algo in ['lagrange', 'bicubic']:
+        for size in GRID_SIZES:
+            if algo == 'bicubic' and size < 4:
+                continue
+            params = {
+                'min_x': 10., 'max_x': 290., 'min_y': 10., 'max_y': 290.,
+                'x_count': size, 'y_count': size, 'mesh_x_pps': options.pps,
+                'mesh_y_pps': options.pps, 'algo': algo, 'tension': .2}
+            z_matrix = [[random.uniform(-.3, .3) for i in range(size)]
+                        for j in range(size)]
+            duration = time_build(params, z_matrix, options.count)
+            mesh_size = (size - 1) * options.pps + size
+            sys.stdout.write("%-8s %2dx%-2d (mesh %3dx%-3d): %8.3fms\n" % (
+                algo, size, size, mesh_size, mesh_size, duration * 1000.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Benchmark the g-code dispatch of a sliced g-code file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import gcode
+gcode_move = importlib.import_module('.gcode_move', 'extras')
+
+
+######################################################################
+# Minimal printer objects
+######################################################################
+
+class BenchMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type=None, value=None, tb=None):
+        pass
+
+class BenchReactor:
+    def mutex(self):
+        return BenchMutex()
+
+class BenchToolHead:
+    def __init__(self):
+        self.moves = []
+    def get_position(self):
+        return [0., 0., 0., 0.]
+    def move(self, newpos, speed):
+        self.moves.append((tuple(newpos), speed))
+
+class BenchPrinter:
+    config_error = gcode.CommandError
+    command_error = gcode.CommandError
+    def __init__(self):
+        self.objects = {}
+        self.reactor = BenchReactor()
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {}
+    def register_event_handler(self, event, callback):
+        pass
+    def send_event(self, event, *params):
+        pass
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def invoke_shutdown(self, msg):
+        pass
+
+class BenchConfig:
+    def __init__(self, printer):
+        self.printer = printer
+    def get_printer(self):
+        return self.printer
+
+def run_dispatch(lines, use_fast_path):
+    printer = BenchPrinter()
+    gcode_dispatch = gcode.GCodeDispatch(printer)
+    printer.objects['gcode'] = gcode_dispatch
+    toolhead = printer.objects['toolhead'] = BenchToolHead()
+    gm = gcode_move.GCodeMove(BenchConfig(printer))
+    if not use_fast_path:
+        gcode_dispatch.move_handlers.clear()
+    gcode_dispatch._handle_ready()
+    gm._handle_ready()
+    start_time = time.time()
+    gcode_dispatch._process_commands(lines)
+    return time.time() - start_time, toolhead.moves
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--runs", type="int", dest="runs", default=3,
+                    help="number of runs per test (best time is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    lines = f.read().decode(errors='replace').split('\n')
+    f.close()
+    tests = [("generic", False), ("fast", True)]
+    best = {}
+    results = {}
+    for i in range(options.runs):
+        for name, use_fast_path in tests:
+            duration, results[name] = run_dispatch(lines, use_fast_path)
+            best[name] = min(best.get(name, duration), duration)
+    for name, use_fast_path in tests:
+        sys.stdout.write("%-8s: %8.0f lines/sec (%d moves)\n" % (
+            name, len(lines) / best[name], len(results[name])))
+    sys.stdout.write("identical moves: %s\n" % (
+        results["generic"] == results["fast"],))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Benchmark the toolhead look-ahead code (C helper vs previous python code)
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import math, optparse, os, random, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import toolhead
+
+
+######################################################################
+# Previous python look-ahead implementation (for comparison)
+######################################################################
+
+def set_junction(move, start_v2, cruise_v2, end_v2):
+    # Determine accel, cruise, and decel portions of the move distance
+    half_inv_accel = .5 / move.accel
+    accel_d = (cruise_v2 - start_v2) * half_inv_accel
+    decel_d = (cruise_v2 - end_v2) * half_inv_accel
+    cruise_d = move.move_d - accel_d - decel_d
+    # Determine move velocities
+    start_v = math.sqrt(start_v2)
+    cruise_v = math.sqrt(cruise_v2)
+    end_v = math.sqrt(end_v2)
+    # Determine time spent in each portion of move (time is the
+    # distance divided by average velocity)
+    move.set_junction((start_v, cruise_v, end_v,
+                       accel_d / ((start_v + cruise_v) * 0.5),
+                       cruise_d / cruise_v,
+                       decel_d / ((end_v + cruise_v) * 0.5)))
+
+class PythonMoveQueue(toolhead.MoveQueue):
+    def flush(self, lazy=False):
+        self.junction_flush = toolhead.LOOKAHEAD_FLUSH_TIME
+        update_flush_count = lazy
+        queue = self.queue
+        flush_count = len(queue)
+        # Traverse queue from last to first move and determine maximum
+        # junction speed assuming the robot comes to a complete stop
+        # after the last move.
+        delayed = []
+        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        for i in range(flush_count-1, -1, -1):
+            move = queue[i]
+            reachable_start_v2 = next_end_v2 + move.delta_v2
+            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            if smoothed_v2 < reachable_smoothed_v2:
+                # It's possible for this move to accelerate
+                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                    or delayed):
+                    # This move can decelerate or this is a full accel
+                    # move after a full decel move
+                    if update_flush_count and peak_cruise_v2:
+                        flush_count = i
+                        update_flush_count = False
+                    peak_cruise_v2 = min(move.max_cruise_v2, (
+                        smoothed_v2 + reachable_smoothed_v2) * .5)
+                    if delayed:
+                        # Propagate peak_cruise_v2 to any delayed moves
+                        if not update_flush_count and i < flush_count:
+                            mc_v2 = peak_cruise_v2
+                            for m, ms_v2, me_v2 in reversed(delayed):
+                                mc_v2 = min(mc_v2, ms_v2)
+                                set_junction(m, min(ms_v2, mc_v2), mc_v2
+                                             , min(me_v2, mc_v2))
+                        del delayed[:]
+                if not update_flush_count and i < flush_count:
+                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                    , move.max_cruise_v2, peak_cruise_v2)
+                    set_junction(move, min(start_v2, cruise_v2), cruise_v2
+                                 , min(next_end_v2, cruise_v2))
+            else:
+                # Delay calculating this move until peak_cruise_v2 is known
+                delayed.append((move, start_v2, next_end_v2))
+            next_end_v2 = start_v2
+            next_smoothed_v2 = smoothed_v2
+        if update_flush_count or not flush_count:
+            return
+        # Generate step times for all moves ready to be flushed
+        self.toolhead._process_moves(queue[:flush_count])
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+    def add_move(self, move):
+        self.queue.append(move)
+        if len(self.queue) == 1:
+            return
+        move.calc_junction(self.queue[-2])
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+
+######################################################################
+# Synthetic toolhead and moves
+######################################################################
+
+class BenchExtruder:
+    instant_corner_v = 1.
+    def calc_junction(self, prev_move, move):
+        diff_r = move.axes_r[3] - prev_move.axes_r[3]
+        if diff_r:
+            return (self.instant_corner_v / abs(diff_r))**2
+        return move.max_cruise_v2
+
+class BenchToolHead:
+    def __init__(self, queue_class):
+        self.max_velocity = 300.
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 5. * 5. * (math.sqrt(2.) - 1.) / 3000.
+        self.extruder = BenchExtruder()
+        self.move_queue = queue_class(self)
+        self.results = []
+    def _process_moves(self, moves):
+        self.results.extend([(m.start_v, m.cruise_v, m.end_v,
+                              m.accel_t, m.cruise_t, m.decel_t)
+                             for m in moves])
+
+# Generate a mix of short extrusion segments (curves and infill),
+# travel moves, z hops, and retracts
+def generate_moves(count):
+    random.seed(0)
+    pos = [0., 0., 0., 0.]
+    moves = []
+    for i in range(count):
+        newpos = list(pos)
+        kind = random.random()
+        if kind < .05:
+            newpos[3] += random.uniform(-2., 2.)
+        elif kind < .10:
+            newpos[0] += random.uniform(-100., 100.)
+            newpos[1] += random.uniform(-100., 100.)
+        elif kind < .12:
+            newpos[2] += random.uniform(0., .3)
+        elif kind < .50:
+            newpos[0] += random.uniform(-1., 1.)
+            newpos[1] += random.uniform(-1., 1.)
+            newpos[3] += random.uniform(0., .05)
+        else:
+            angle = i * .3
+            newpos[0] += math.cos(angle) * .5
+            newpos[1] += math.sin(angle) * .5
+            newpos[3] += .02
+        moves.append((newpos, random.choice([20., 100., 300., 500.])))
+        pos = newpos
+    return moves
+
+def run_moves(queue_class, moves):
+    th = BenchToolHead(queue_class)
+    move_queue = th.move_queue
+    pos = [0., 0., 0., 0.]
+    start_time = time.time()
+    for newpos, speed in moves:
+        move = toolhead.Move(th, pos, newpos, speed)
+        if not move.move_d:
+            continue
+        if not move.is_kinematic_move or not (move.axes_d[0]
+                                              or move.axes_d[1]):
+            move.limit_speed(50., 1000.)
+        move_queue.add_move(move)
+        pos = move.end_pos
+    move_queue.flush()
+    return time.time() - start_time, th.results
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=200000,
+                    help="number of moves to queue")
+    opts.add_option("-r", "--runs", type="int", dest="runs", default=3,
+                    help="number of runs per test (best time is reported)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    moves = generate_moves(options.count)
+    tests = [("python", PythonMoveQueue), ("c", toolhead.MoveQueue)]
+    best = {}
+    results = {}
+    for i in range(options.runs):
+        for name, queue_class in tests:
+            duration, results[name] = run_moves(queue_class, moves)
+            best[name] = min(best.get(name, duration), duration)
+    for name, queue_class in tests:
+        sys.stdout.write("%-6s: %8.0f moves/sec\n" % (
+            name, len(moves) / best[name]))
+    sys.stdout.write("identical results: %s\n" % (
+        results["python"] == results["c"],))
+
+if __name__ == '__main__':
+    main()
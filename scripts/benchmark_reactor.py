@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Benchmark reactor timer dispatch with a varying number of timers
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor
+
+TIMER_COUNTS = [1, 10, 100, 1000, 10000]
+
+# Add timers that wake up about once a second (like typical periodic
+# checks of heaters, fans, buttons, etc.)
+def add_background_timers(r, count):
+    start_time = r.monotonic() + 1.
+    def background_event(eventtime):
+        return eventtime + 1.
+    for i in range(count):
+        r.register_timer(background_event, start_time + float(i) / count)
+
+def time_dispatch(count, dispatches):
+    # Report the time to wake a timer that is always ready
+    r = reactor.Reactor()
+    add_background_timers(r, count)
+    state = {'count': 0}
+    def ready_event(eventtime):
+        state['count'] += 1
+        if state['count'] >= dispatches:
+            r.end()
+            return r.NEVER
+        return r.NOW
+    r.register_timer(ready_event, r.NOW)
+    start = time.time()
+    r.run()
+    duration = time.time() - start
+    r.finalize()
+    return duration / dispatches
+
+def time_update(count, updates):
+    # Report the time to reschedule a timer (and then dispatch it)
+    r = reactor.Reactor()
+    add_background_timers(r, count)
+    state = {'count': 0}
+    def update_event(eventtime):
+        state['count'] += 1
+        if state['count'] >= updates:
+            r.end()
+            return r.NEVER
+        r.update_timer(other_timer, eventtime + 10.)
+        r.unregister_timer(r.register_timer(update_event, r.NEVER))
+        return r.NOW
+    other_timer = r.register_timer(update_event, r.NEVER)
+    r.register_timer(update_event, r.NOW)
+    start = time.time()
+    r.run()
+    duration = time.time() - start
+    r.finalize()
+    return duration / updates
+
+def time_pause(count, pauses):
+    # Report the time for a greenlet to pause and be resumed
+    r = reactor.Reactor()
+    add_background_timers(r, count)
+    def pause_event(eventtime):
+        for i in range(pauses):
+            r.pause(r.NOW)
+        r.end()
+        return r.NEVER
+    r.register_timer(pause_event, r.NOW)
+    start = time.time()
+    r.run()
+    duration = time.time() - start
+    r.finalize()
+    return duration / pauses
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=20000,
+                    help="number of events per test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    sys.stdout.write("reactor: %s\n" % (reactor.Reactor.__name__,))
+    for count in TIMER_COUNTS:
+        dispatch = time_dispatch(count, options.count)
+        update = time_update(count, options.count)
+        pause = time_pause(count, options.count)
+        sys.stdout.write("%5d timers: dispatch %7.2fus update %7.2fus"
+                         " pause %7.2fus\n" % (
+                             count, dispatch * 1000000., update * 1000000.,
+                             pause * 1000000.))
+
+if __name__ == '__main__':
+    main()
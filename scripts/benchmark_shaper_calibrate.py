@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Benchmark input shaper fitting (vectorized vs previous scalar code)
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, math, optparse, os, sys, time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+
+
+######################################################################
+# Previous scalar shaper fitting implementation (for comparison)
+######################################################################
+
+class ScalarShaperCalibrate(shaper_calibrate.ShaperCalibrate):
+    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+        A, T = np.array(shaper[0]), np.array(shaper[1])
+        inv_D = 1. / A.sum()
+
+        omega = 2. * math.pi * test_freqs
+        damping = test_damping_ratio * omega
+        omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
+        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
+        S = W * np.sin(np.outer(omega_d, T))
+        C = W * np.cos(np.outer(omega_d, T))
+        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
+                                       freq_bins, psd):
+        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        remaining_vibrations = np.maximum(
+                vals * psd - vibr_threshold, 0).sum()
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        return (remaining_vibrations / all_vibrations, vals)
+    def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
+        half_accel = accel * .5
+
+        A, T = shaper
+        inv_D = 1. / sum(A)
+        n = len(T)
+        # Calculate input shaper shift
+        ts = sum([A[i] * T[i] for i in range(n)]) * inv_D
+
+        # Calculate offset for 90 and 180 degrees turn
+        offset_90 = offset_180 = 0.
+        for i in range(n):
+            if T[i] >= ts:
+                # Calculate offset for one of the axes
+                offset_90 += A[i] * (scv + half_accel * (T[i]-ts)) * (T[i]-ts)
+            offset_180 += A[i] * half_accel * (T[i]-ts)**2
+        offset_90 *= inv_D * math.sqrt(2.)
+        offset_180 *= inv_D
+        return max(offset_90, offset_180)
+    def fit_shaper(self, shaper_cfg, calibration_data, max_smoothing):
+        test_freqs = np.arange(shaper_cfg.min_freq,
+                               shaper_calibrate.MAX_SHAPER_FREQ, .2)
+
+        freq_bins = calibration_data.freq_bins
+        psd = calibration_data.psd_sum[freq_bins <= shaper_calibrate.MAX_FREQ]
+        freq_bins = freq_bins[freq_bins <= shaper_calibrate.MAX_FREQ]
+
+        best_res = None
+        results = []
+        for test_freq in test_freqs[::-1]:
+            shaper_vibrations = 0.
+            shaper_vals = np.zeros(shape=freq_bins.shape)
+            shaper = shaper_cfg.init_func(
+                    test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
+            shaper_smoothing = self._get_shaper_smoothing(shaper)
+            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
+                return best_res
+            for dr in shaper_calibrate.TEST_DAMPING_RATIOS:
+                vibrations, vals = self._estimate_remaining_vibrations(
+                        shaper, dr, freq_bins, psd)
+                shaper_vals = np.maximum(shaper_vals, vals)
+                if vibrations > shaper_vibrations:
+                    shaper_vibrations = vibrations
+            max_accel = self.find_shaper_max_accel(shaper)
+            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
+                                               shaper_vibrations * .2 + .01)
+            results.append(
+                    shaper_calibrate.CalibrationResult(
+                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
+                        score=shaper_score, max_accel=max_accel))
+            if best_res is None or best_res.vibrs > results[-1].vibrs:
+                best_res = results[-1]
+        selected = best_res
+        for res in results[::-1]:
+            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
+                selected = res
+        return selected
+    def _bisect(self, func):
+        left = right = 1.
+        while not func(left):
+            right = left
+            left *= .5
+        if right == left:
+            while func(right):
+                right *= 2.
+        while right - left > 1e-8:
+            middle = (left + right) * .5
+            if func(middle):
+                left = middle
+            else:
+                right = middle
+        return left
+    def find_shaper_max_accel(self, shaper):
+        TARGET_SMOOTHING = 0.12
+        max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
+            shaper, test_accel) <= TARGET_SMOOTHING)
+        return max_accel
+
+
+######################################################################
+# Synthetic calibration data
+######################################################################
+
+# Generate the PSD of one or two resonances on top of broadband noise,
+# sampled as an accelerometer test would (3200Hz with 0.5s windows)
+def generate_data(rs, sampling_freq=3200.):
+    nfft = 1 << int(sampling_freq * shaper_calibrate.WINDOW_T_SEC
+                    - 1).bit_length()
+    freq_bins = np.fft.rfftfreq(nfft, 1. / sampling_freq)
+    psd = rs.uniform(0., 50., (3, len(freq_bins)))
+    for i in range(rs.randint(1, 3)):
+        peak_freq = rs.uniform(25., 90.)
+        width = rs.uniform(2., 8.)
+        amplitude = rs.uniform(1e3, 1e4)
+        psd += rs.uniform(.1, 1., (3, 1)) * amplitude / (
+            1. + ((freq_bins - peak_freq) / width)**2)
+    data = shaper_calibrate.CalibrationData(
+        freq_bins, psd.sum(axis=0), psd[0], psd[1], psd[2])
+    data.set_numpy(np)
+    data.normalize_to_frequencies()
+    return data
+
+def run_fits(helper, datasets, max_smoothing):
+    start_time = time.time()
+    results = []
+    for data in datasets:
+        fits = [helper.fit_shaper(shaper_cfg, data, max_smoothing)
+                for shaper_cfg in shaper_defs.INPUT_SHAPERS]
+        results.append((helper._select_best_shaper(fits).name, fits))
+    return time.time() - start_time, results
+
+def check_close(desc, a, b, rel_tol):
+    if abs(a - b) > rel_tol * max(abs(a), abs(b), 1e-12):
+        raise AssertionError("%s mismatch: %.12g vs %.12g" % (desc, a, b))
+
+def compare_results(scalar_results, vector_results):
+    for (s_best, s_fits), (v_best, v_fits) in zip(scalar_results,
+                                                  vector_results):
+        if s_best != v_best:
+            raise AssertionError("best shaper mismatch: %s vs %s" % (
+                s_best, v_best))
+        for s, v in zip(s_fits, v_fits):
+            desc = "%s@%.1f" % (s.name, s.freq)
+            if s.name != v.name or abs(s.freq - v.freq) > 1e-9:
+                raise AssertionError("%s frequency mismatch: %.1f" % (
+                    desc, v.freq))
+            check_close(desc + " vibrations", s.vibrs, v.vibrs, 1e-9)
+            check_close(desc + " smoothing", s.smoothing, v.smoothing, 1e-9)
+            check_close(desc + " score", s.score, v.score, 1e-9)
+            check_close(desc + " max_accel", s.max_accel, v.max_accel, 1e-6)
+            if not np.allclose(s.vals, v.vals, rtol=1e-9, atol=1e-12):
+                raise AssertionError("%s shaper response mismatch" % (desc,))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=10,
+                    help="number of synthetic calibration data sets")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random seed for the synthetic data")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    rs = np.random.RandomState(options.seed)
+    datasets = [generate_data(rs) for i in range(options.count)]
+    tests = [("scalar", ScalarShaperCalibrate(None)),
+             ("vector", shaper_calibrate.ShaperCalibrate(None))]
+    for max_smoothing in [None, .1]:
+        durations = {}
+        results = {}
+        for name, helper in tests:
+            durations[name], results[name] = run_fits(
+                helper, datasets, max_smoothing)
+        compare_results(results["scalar"], results["vector"])
+        for name, helper in tests:
+            sys.stdout.write("max_smoothing=%s %-6s: %7.3fs (%.1f ms/fit)\n"
+                             % (max_smoothing, name, durations[name],
+                                1000. * durations[name] / (
+                                    len(datasets)
+                                    * len(shaper_defs.INPUT_SHAPERS))))
+        sys.stdout.write("max_smoothing=%s identical results: True\n" % (
+            max_smoothing,))
+
+if __name__ == '__main__':
+    main()
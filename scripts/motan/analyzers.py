@@ -3,8 +3,12 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, collections
+import math, collections, multiprocessing
 import readlog
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ######################################################################
@@ -14,6 +18,27 @@ import readlog
 # Analyzer handlers: {name: class, ...}
 AHandlers = {}
 
+# Calculate out[i] = weight * out[i-1] + inp[i] (with out[-1] = initial)
+# on a numpy array.  The input is split into blocks that are filtered
+# concurrently, and then the contribution of the preceding blocks is
+# added to each block.
+def linear_recurrence(inp, weight, initial):
+    count = len(inp)
+    block_size = max(1, int(math.sqrt(count)))
+    block_count = (count + block_size - 1) // block_size
+    padded = numpy.zeros(block_count * block_size)
+    padded[:count] = inp
+    blocks = padded.reshape(block_count, block_size).T.copy()
+    for i in range(1, block_size):
+        blocks[i] += weight * blocks[i-1]
+    block_weight = weight ** block_size
+    starts = [initial]
+    for block_end in blocks[-1][:-1]:
+        starts.append(block_weight * starts[-1] + block_end)
+    weights = weight ** numpy.arange(1, block_size + 1)
+    blocks += numpy.outer(weights, starts)
+    return blocks.T.ravel()[:count]
+
 # Calculate a derivative (position to velocity, or velocity to accel)
 class GenDerivative:
     ParametersMin = ParametersMax = 1
@@ -41,6 +66,9 @@ class GenDerivative:
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
         data = self.amanager.get_datasets()[self.source]
+        if numpy is not None:
+            deriv = numpy.diff(data) * inv_seg_time
+            return numpy.concatenate((deriv[:1], deriv))
         deriv = [(data[i+1] - data[i]) * inv_seg_time
                  for i in range(len(data)-1)]
         return [deriv[0]] + deriv
@@ -83,6 +111,8 @@ class GenIntegral:
             units = units.replace(old, new).replace(old.lower(), new.lower())
         return {'label': lname, 'units': units}
     def generate_data(self):
+        if numpy is not None:
+            return self.generate_data_numpy()
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
         offset = sum(src) / len(src)
@@ -103,6 +133,21 @@ class GenIntegral:
                 total = src_weight * total + ref_weight * ref[i]
             data[i] = total
         return data
+    def generate_data_numpy(self):
+        seg_time = self.amanager.get_segment_time()
+        src = self.amanager.get_datasets()[self.source]
+        offset = numpy.mean(src)
+        if self.ref is None:
+            return numpy.cumsum((src - offset) * seg_time)
+        ref = self.amanager.get_datasets()[self.ref]
+        offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
+        src_weight = 1.
+        if self.half_life:
+            src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
+        # Each output is total[i] = src_weight * total[i-1] + inp[i]
+        inp = (src_weight * seg_time * (src - offset)
+               + (1. - src_weight) * ref)
+        return linear_recurrence(inp, src_weight, ref[0])
 AHandlers["integral"] = GenIntegral
 
 # Calculate a kinematic stepper position from the toolhead requested position
@@ -140,11 +185,15 @@ class GenKinematicPosition:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 + data2
         return [d1 + d2 for d1, d2 in zip(data1, data2)]
     def generate_data_corexy_minus(self):
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 - data2
         return [d1 - d2 for d1, d2 in zip(data1, data2)]
     def generate_data_passthrough(self):
         return self.amanager.get_datasets()[self.source1]
@@ -173,6 +222,10 @@ class GenCorexyPosition:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            if self.is_plus:
+                return .5 * (data1 + data2)
+            return .5 * (data1 - data2)
         if self.is_plus:
             return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
         return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
@@ -201,6 +254,8 @@ class GenDeviation:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 - data2
         return [d1 - d2 for d1, d2 in zip(data1, data2)]
 AHandlers["deviation"] = GenDeviation
 
@@ -216,6 +271,41 @@ def list_datasets():
         datasets += AHandlers[ah].DataSets
     return datasets
 
+DATA_CHUNK_TIME = 0.500
+
+# Pull data from a list of (data_list, handler) pairs.  The requested
+# times are processed in chunks so that log messages are consumed by
+# all datasets at a similar rate.
+def pull_datasets(list_hdls, time_chunks):
+    for req_times in time_chunks:
+        for dl, hdl in list_hdls:
+            if hasattr(hdl, 'pull_data_many'):
+                dl.extend(hdl.pull_data_many(req_times))
+            else:
+                dl.extend([hdl.pull_data(rt) for rt in req_times])
+
+# Convert a list of raw samples to a numpy array (if possible)
+def to_array(data):
+    if numpy is None:
+        return data
+    try:
+        return numpy.asarray(data, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        # Not a numeric dataset
+        return data
+
+# Generate a raw dataset from a separately opened log (for use in a
+# background process)
+def generate_raw_dataset(job):
+    log_position, name, time_chunks = job
+    log_prefix, seek_request = log_position
+    lmanager = readlog.LogManager(log_prefix)
+    lmanager.setup_index()
+    lmanager.seek_time(seek_request)
+    data = []
+    pull_datasets([(data, lmanager.setup_dataset(name))], time_chunks)
+    return to_array(data)
+
 # Manage raw and generated data samples
 class AnalyzerManager:
     error = None
@@ -228,8 +318,11 @@ class AnalyzerManager:
         self.datasets = {}
         self.dataset_times = []
         self.duration = 5.
+        self.processes = 1
     def set_duration(self, duration):
         self.duration = duration
+    def set_processes(self, processes):
+        self.processes = processes
     def get_segment_time(self):
         return self.segment_time
     def get_datasets(self):
@@ -266,18 +359,45 @@ class AnalyzerManager:
             if hdl is None:
                 raise error("Unknown dataset '%s'" % (dataset,))
         return hdl.get_label()
-    def generate_datasets(self):
-        # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
-        initial_start_time = self.lmanager.get_initial_start_time()
+    def _get_time_chunks(self):
         start_time = t = self.lmanager.get_start_time()
         end_time = start_time + self.duration
+        time_chunks = []
         while t < end_time:
-            t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
+            req_times = []
+            chunk_end_time = min(t + DATA_CHUNK_TIME, end_time)
+            while t < chunk_end_time:
+                t += self.segment_time
+                req_times.append(t)
+            time_chunks.append(req_times)
+        return time_chunks
+    def _generate_raw_parallel(self, time_chunks):
+        # Decode each raw dataset in a separate process
+        log_position = self.lmanager.get_log_position()
+        names = list(self.raw_datasets.keys())
+        jobs = [(log_position, name, time_chunks) for name in names]
+        pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+        try:
+            results = pool.map(generate_raw_dataset, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        for name, data in zip(names, results):
+            self.datasets[name] = data
+    def generate_datasets(self):
+        # Generate raw data
+        time_chunks = self._get_time_chunks()
+        initial_start_time = self.lmanager.get_initial_start_time()
+        self.dataset_times = [t - initial_start_time
+                              for req_times in time_chunks for t in req_times]
+        if self.processes > 1 and len(self.raw_datasets) > 1:
+            self._generate_raw_parallel(time_chunks)
+        else:
+            list_hdls = [(self.datasets[name], hdl)
+                         for name, hdl in self.raw_datasets.items()]
+            pull_datasets(list_hdls, time_chunks)
+        for name in self.raw_datasets:
+            self.datasets[name] = to_array(self.datasets[name])
         # Generate analyzer data
         for name, hdl in self.gen_datasets.items():
             self.datasets[name] = hdl.generate_data()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Benchmark the motan analyzers on a synthetic capture
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, math, random, time
+import readlog, analyzers
+
+DATASETS = [
+    "derivative(trapq(toolhead,x))",
+    "derivative(derivative(trapq(toolhead,y)))",
+    "integral(trapq(toolhead,x_velocity))",
+    "integral(adxl345(adxl345,x),trapq(toolhead,x_velocity))",
+    "kin(stepper_x)", "kin(stepper_y)",
+    "corexy(x,stepq(stepper_x),stepq(stepper_y))",
+    "deviation(stepq(stepper_x),kin(stepper_x))",
+]
+
+
+######################################################################
+# Synthetic capture
+######################################################################
+
+class SyntheticDataset:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.pos = 0
+    def get_label(self):
+        return {'label': self.name, 'units': 'Unknown'}
+    def pull_data_many(self, req_times):
+        start_pos = self.pos
+        self.pos += len(req_times)
+        return self.data[start_pos:self.pos]
+
+# Generate toolhead motion (a series of random moves with a sinusoidal
+# velocity profile) along with noisy stepper and accelerometer data
+def generate_capture(duration, segment_time):
+    count = int(duration / segment_time) + 2
+    random.seed(0)
+    capture = {}
+    for axis in 'xy':
+        pos = 150.
+        positions = []
+        velocities = []
+        while len(positions) < count:
+            move_count = random.randint(100, 2000)
+            dist = random.uniform(-50., 50.)
+            for i in range(move_count):
+                ratio = float(i) / move_count
+                positions.append(pos + dist * .5 * (1. - math.cos(
+                    math.pi * ratio)))
+                velocities.append(dist * .5 * math.pi * math.sin(
+                    math.pi * ratio) / (move_count * segment_time))
+            pos += dist
+        capture['trapq(toolhead,%s)' % (axis,)] = positions[:count]
+        capture['trapq(toolhead,%s_velocity)' % (axis,)] = velocities[:count]
+    xpos = capture['trapq(toolhead,x)']
+    ypos = capture['trapq(toolhead,y)']
+    capture['stepq(stepper_x)'] = [x + y + random.gauss(0., .005)
+                                   for x, y in zip(xpos, ypos)]
+    capture['stepq(stepper_y)'] = [x - y + random.gauss(0., .005)
+                                   for x, y in zip(xpos, ypos)]
+    capture['adxl345(adxl345,x)'] = [random.gauss(0., 500.)
+                                     for i in range(count)]
+    return capture
+
+class SyntheticLogManager:
+    error = readlog.error
+    def __init__(self, capture):
+        self.capture = capture
+    def available_dataset_types(self):
+        return {'trapq': None, 'stepq': None, 'adxl345': None}
+    def get_initial_status(self):
+        return {'configfile': {'settings': {
+            'printer': {'kinematics': 'corexy'}}}}
+    def get_initial_start_time(self):
+        return 0.
+    def get_start_time(self):
+        return 0.
+    def setup_dataset(self, name):
+        return SyntheticDataset(name, self.capture[name])
+
+
+######################################################################
+# Startup
+######################################################################
+
+def run_analyzers(capture, options):
+    amanager = analyzers.AnalyzerManager(SyntheticLogManager(capture),
+                                         options.segment_time)
+    amanager.set_duration(options.duration)
+    for dataset in DATASETS:
+        amanager.setup_dataset(dataset)
+    start_time = time.time()
+    amanager.generate_datasets()
+    total_time = time.time() - start_time
+    # Time just the analyzers (on the already gathered raw datasets)
+    start_time = time.time()
+    for hdl in amanager.gen_datasets.values():
+        hdl.generate_data()
+    return amanager.get_datasets(), total_time, time.time() - start_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--duration", type="float", default=600.,
+                    help="Number of seconds in the capture (default 600)")
+    opts.add_option("--segment-time", type="float", default=0.001,
+                    help="Analysis segment time (default 0.001 seconds)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    capture = generate_capture(options.duration, options.segment_time)
+    numpy = analyzers.numpy
+    results = []
+    for use_numpy in [False, True]:
+        if use_numpy and numpy is None:
+            sys.stdout.write("numpy: not available\n")
+            break
+        analyzers.numpy = numpy if use_numpy else None
+        datasets, total_time, gen_time = run_analyzers(capture, options)
+        sys.stdout.write("%-6s: total %7.3fs analyzers %7.3fs"
+                         " (%d samples per dataset)\n" % (
+                             "numpy" if use_numpy else "python", total_time,
+                             gen_time, len(datasets[DATASETS[0]])))
+        results.append(datasets)
+    if len(results) == 2:
+        # Report the largest difference between the two implementations
+        for dataset in DATASETS:
+            diff = max([abs(a - b) for a, b in zip(results[0][dataset],
+                                                   results[1][dataset])])
+            sys.stdout.write("%-56s max diff %.3g\n" % (dataset, diff))
+
+if __name__ == '__main__':
+    main()
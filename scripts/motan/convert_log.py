@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Convert a data_logger.py log into an indexed chunked log
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, struct, base64, zlib
+import readlog
+
+CHUNK_TIME = 1.
+KEYFRAME_CHUNKS = 30
+
+# Row formats used to pack dump messages logged as json lists
+JSON_DATA_FORMATS = {
+    'trapq': '<10d', 'stepq': '<Iih', 'adxl345': '<4d',
+}
+
+def flatten_row(row):
+    res = []
+    for v in row:
+        if type(v) == list:
+            res.extend(v)
+        else:
+            res.append(v)
+    return res
+
+class ChunkLogWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename + ".tmp", "wb")
+        self.file.write(readlog.CHUNK_LOG_HEADER.pack(
+            readlog.CHUNK_LOG_MAGIC, 0))
+        self.file_pos = readlog.CHUNK_LOG_HEADER.size
+        self.chunks = []
+        self.blocks = {}
+        self.initial = None
+        self.status = {}
+    def _write_block(self, data):
+        data = zlib.compress(data)
+        self.file.write(data)
+        location = (self.file_pos, len(data))
+        self.file_pos += len(data)
+        return location
+    def set_initial(self, initial):
+        self.initial = {'status': initial['status'],
+                        'subscriptions': initial.get('subscriptions', {})}
+        self.status = json.loads(json.dumps(initial['status']))
+    def _pack_message(self, qid, params):
+        # Return the json parameters and packed data of a message
+        data = params.get('data')
+        if data is None:
+            return params, b""
+        params = dict(params)
+        del params['data']
+        data_format = params.get('data_format')
+        if data_format is not None:
+            raw = base64.b64decode(data)
+        else:
+            data_format = JSON_DATA_FORMATS.get(qid.split(':')[0])
+            if data_format is None:
+                # Unknown data - store as json
+                params['data'] = data
+                return params, b""
+            s = struct.Struct(data_format)
+            raw = b"".join([s.pack(*flatten_row(row)) for row in data])
+            params['data_format'] = data_format
+        params['rows'] = len(raw) // struct.calcsize(data_format)
+        return params, raw
+    def add_message(self, qid, params):
+        block = self.blocks.get(qid)
+        if block is None:
+            block = self.blocks[qid] = ([], [])
+        params, raw = self._pack_message(qid, params)
+        block[0].append(params)
+        block[1].append(raw)
+        if qid == 'status':
+            for k, v in params.get('status', {}).items():
+                self.status.setdefault(k, {}).update(v)
+    def start_chunk(self):
+        if self.chunks:
+            self.flush_chunk()
+        th = self.status.get('toolhead', {})
+        ptime = max(th.get('estimated_print_time', 0.),
+                    th.get('print_time', 0.))
+        chunk = {'time': ptime, 'blocks': {}}
+        if not len(self.chunks) % KEYFRAME_CHUNKS:
+            chunk['keyframe'] = self._write_block(json.dumps(
+                self.status, separators=(',', ':')).encode())
+        self.chunks.append(chunk)
+    def flush_chunk(self):
+        chunk_blocks = self.chunks[-1]['blocks']
+        for qid, (msgs, raws) in sorted(self.blocks.items()):
+            meta = json.dumps(msgs, separators=(',', ':')).encode()
+            chunk_blocks[qid] = self._write_block(
+                readlog.CHUNK_BLOCK_HEADER.pack(len(meta)) + meta
+                + b"".join(raws))
+        self.blocks = {}
+    def close(self):
+        if self.chunks:
+            self.flush_chunk()
+        index_pos = self.file_pos
+        index = {'initial': self.initial, 'chunks': self.chunks}
+        self.file.write(zlib.compress(json.dumps(
+            index, separators=(',', ':')).encode()))
+        self.file.seek(0)
+        self.file.write(readlog.CHUNK_LOG_HEADER.pack(
+            readlog.CHUNK_LOG_MAGIC, index_pos))
+        self.file.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+def convert(log_prefix, dest_filename):
+    index_reader = readlog.JsonLogReader(log_prefix + ".index.gz")
+    log_reader = readlog.JsonLogReader(log_prefix + ".json.gz")
+    writer = ChunkLogWriter(dest_filename)
+    writer.set_initial(index_reader.pull_msg())
+    writer.start_chunk()
+    next_chunk_time = writer.chunks[0]['time'] + CHUNK_TIME
+    msg_count = 0
+    while 1:
+        jmsg = log_reader.pull_msg()
+        if jmsg is None:
+            break
+        qid = jmsg.get('q')
+        if qid is None:
+            # Query responses are not needed
+            continue
+        params = jmsg['params']
+        if qid == 'status':
+            th = params.get('status', {}).get('toolhead', {})
+            ptime = th.get('estimated_print_time')
+            if ptime is not None and ptime >= next_chunk_time:
+                writer.start_chunk()
+                next_chunk_time = ptime + CHUNK_TIME
+        writer.add_message(qid, params)
+        msg_count += 1
+    writer.close()
+    return msg_count, len(writer.chunks)
+
+def main():
+    usage = "%prog [options] <log name>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-o", "--output", type="string", dest="output",
+                    default=None, help="name of the converted log")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    log_prefix = args[0]
+    dest_prefix = options.output
+    if dest_prefix is None:
+        dest_prefix = log_prefix
+    msg_count, chunk_count = convert(log_prefix,
+                                     dest_prefix + readlog.CHUNK_LOG_EXT)
+    sys.stdout.write("Converted %d messages into %d chunks\n"
+                     % (msg_count, chunk_count))
+
+if __name__ == '__main__':
+    main()
@@ -53,7 +53,7 @@ class LogWriter:
         self.comp = None
 
 class DataLogger:
-    def __init__(self, uds_filename, log_prefix):
+    def __init__(self, uds_filename, log_prefix, binary_dumps=True):
         # IO
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
@@ -68,6 +68,7 @@ class DataLogger:
         # get_status databasing
         self.db = {}
         self.next_index_time = 0.
+        self.binary_dumps = binary_dumps
         # Start login process
         self.send_query("info", "info", {"client_info": ClientInfo},
                         self.handle_info)
@@ -126,6 +127,8 @@ class DataLogger:
     def send_subscribe(self, msg_id, method, params, cb=None, async_cb=None):
         if cb is None:
             cb = self.handle_dump
+            if self.binary_dumps:
+                params["binary"] = True
         if async_cb is not None:
             self.async_handlers[msg_id] = async_cb
         params["response_template"] = {"q": msg_id}
@@ -188,12 +191,14 @@ def nice():
 def main():
     usage = "%prog [options] <socket filename> <log name>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-j", "--json", action="store_false", dest="binary",
+                    default=True, help="log dump data as json lists")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
 
     nice()
-    dl = DataLogger(args[0], args[1])
+    dl = DataLogger(args[0], args[1], options.binary)
     dl.run()
 
 if __name__ == '__main__':
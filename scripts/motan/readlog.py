@@ -3,11 +3,21 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import json, zlib, struct, base64, array, bisect, logging, os, sys
 
 class error(Exception):
     pass
 
+# Return the klippy C helper library (or None if it is not available)
+def get_chelper():
+    try:
+        sys.path.append(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '..', '..', 'klippy'))
+        import chelper
+        return chelper.get_ffi()
+    except Exception:
+        return None, None
+
 
 ######################################################################
 # Log data handlers
@@ -16,6 +26,19 @@ class error(Exception):
 # Log data handlers: {name: class, ...}
 LogHandlers = {}
 
+# Return the rows of a dump message "data" field (which may contain
+# packed binary data - base64 encoded unless read from a chunked log)
+def get_data_rows(jmsg):
+    data = jmsg['data']
+    data_format = jmsg.get('data_format')
+    if data_format is None:
+        return data
+    s = struct.Struct(data_format)
+    raw = data
+    if not isinstance(data, bytes):
+        raw = base64.b64decode(data)
+    return [s.unpack_from(raw, i) for i in range(0, len(raw), s.size)]
+
 # Extract requested position, velocity, and accel from a trapq log
 class HandleStatusField:
     SubscriptionIdParts = 0
@@ -43,6 +66,10 @@ class HandleStatusField:
         return self.result
 LogHandlers["status"] = HandleStatusField
 
+# Number of doubles in a "struct pull_position" (x, y, z, velocity,
+# accel, x/y/z velocity, x/y/z accel)
+PULL_POSITION_FIELDS = 11
+
 # Extract requested position, velocity, and accel from a trapq log
 class HandleTrapQ:
     SubscriptionIdParts = 2
@@ -63,25 +90,29 @@ class HandleTrapQ:
         ptypes = {}
         ptypes['velocity'] = {
             'label': '%s velocity' % (trapq_name,),
-            'units': 'Velocity\n(mm/s)', 'func': self._pull_velocity
+            'units': 'Velocity\n(mm/s)', 'func': self._pull_velocity,
+            'sample_field': 3
         }
         ptypes['accel'] = {
             'label': '%s acceleration' % (trapq_name,),
-            'units': 'Acceleration\n(mm/s^2)', 'func': self._pull_accel
+            'units': 'Acceleration\n(mm/s^2)', 'func': self._pull_accel,
+            'sample_field': 4
         }
         for axis, name in enumerate("xyz"):
             ptypes['%s' % (name,)] = {
                 'label': '%s %s position' % (trapq_name, name), 'axis': axis,
-                'units': 'Position\n(mm)', 'func': self._pull_axis_position
+                'units': 'Position\n(mm)', 'func': self._pull_axis_position,
+                'sample_field': axis
             }
             ptypes['%s_velocity' % (name,)] = {
                 'label': '%s %s velocity' % (trapq_name, name), 'axis': axis,
-                'units': 'Velocity\n(mm/s)', 'func': self._pull_axis_velocity
+                'units': 'Velocity\n(mm/s)', 'func': self._pull_axis_velocity,
+                'sample_field': 5 + axis
             }
             ptypes['%s_accel' % (name,)] = {
                 'label': '%s %s acceleration' % (trapq_name, name),
                 'axis': axis, 'units': 'Acceleration\n(mm/s^2)',
-                'func': self._pull_axis_accel
+                'func': self._pull_axis_accel, 'sample_field': 8 + axis
             }
         pinfo = ptypes.get(datasel)
         if pinfo is None:
@@ -89,8 +120,53 @@ class HandleTrapQ:
         self.label = {'label': pinfo['label'], 'units': pinfo['units']}
         self.axis = pinfo.get('axis')
         self.pull_data = pinfo['func']
+        self.sample_field = pinfo['sample_field']
+        self.ffi_main, self.ffi_lib = get_chelper()
+        if self.ffi_main is None:
+            self.pull_data_many = self._pull_data_many_python
     def get_label(self):
         return self.label
+    def _pull_data_many_python(self, req_times):
+        return [self.pull_data(t) for t in req_times]
+    def pull_data_many(self, req_times):
+        # Evaluate a sorted list of times using the C helper code
+        if not req_times:
+            return []
+        ffi_main, ffi_lib = self.ffi_main, self.ffi_lib
+        # Load all moves needed for the requested times
+        end_time = req_times[-1]
+        moves = self.cur_data[self.data_pos:]
+        while moves[-1][0] + moves[-1][1] < end_time:
+            jmsg = self.jdispatch.pull_msg(end_time, self.name)
+            if jmsg is None:
+                break
+            rows = get_data_rows(jmsg)
+            if 'data_format' in jmsg:
+                rows = [(r[0], r[1], r[2], r[3], r[4:7], r[7:10])
+                        for r in rows]
+            moves = moves + rows
+        cmoves = ffi_main.new('struct pull_move[]', len(moves))
+        for cm, move in zip(cmoves, moves):
+            print_time, move_t, start_v, accel, start_pos, axes_r = move
+            cm.print_time = print_time
+            cm.move_t = move_t
+            cm.start_v = start_v
+            cm.accel = accel
+            cm.start_x, cm.start_y, cm.start_z = start_pos
+            cm.x_r, cm.y_r, cm.z_r = axes_r
+        count = len(req_times)
+        out = ffi_main.new('struct pull_position[]', count)
+        last_pos = ffi_lib.trapq_sample_moves(cmoves, len(moves), req_times,
+                                              out, count)
+        self.cur_data = moves[last_pos:]
+        self.data_pos = 0
+        fields = array.array('d')
+        if hasattr(fields, 'frombytes'):
+            fields.frombytes(ffi_main.buffer(out))
+        else:
+            # Python2
+            fields.fromstring(ffi_main.buffer(out)[:])
+        return fields[self.sample_field::PULL_POSITION_FIELDS].tolist()
     def _find_move(self, req_time):
         data_pos = self.data_pos
         while 1:
@@ -105,7 +181,10 @@ class HandleTrapQ:
             jmsg = self.jdispatch.pull_msg(req_time, self.name)
             if jmsg is None:
                 return move, False
-            self.cur_data = jmsg['data']
+            self.cur_data = get_data_rows(jmsg)
+            if 'data_format' in jmsg:
+                self.cur_data = [(r[0], r[1], r[2], r[3], r[4:7], r[7:10])
+                                 for r in self.cur_data]
             self.data_pos = data_pos = 0
     def _pull_axis_position(self, req_time):
         move, in_range = self._find_move(req_time)
@@ -209,7 +288,8 @@ class HandleStepQ:
         # Process block into (time, half_position, position) 3-tuples
         first_time = step_time = jmsg['first_step_time']
         first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
+        data = get_data_rows(jmsg)
+        step_clock = first_clock - data[0][0]
         cdiff = jmsg['last_clock'] - first_clock
         tdiff = last_time - first_time
         inv_freq = 0.
@@ -217,7 +297,7 @@ class HandleStepQ:
             inv_freq = tdiff / cdiff
         step_dist = jmsg['step_distance']
         step_pos = jmsg['start_position']
-        for interval, raw_count, add in jmsg['data']:
+        for interval, raw_count, add in data:
             qs_dist = step_dist
             count = raw_count
             if count < 0:
@@ -309,14 +389,15 @@ class HandleStepPhase:
         # Process block into (time, position) 2-tuples
         first_time = step_time = jmsg['first_step_time']
         first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
+        data = get_data_rows(jmsg)
+        step_clock = first_clock - data[0][0]
         cdiff = jmsg['last_clock'] - first_clock
         tdiff = last_time - first_time
         inv_freq = 0.
         if cdiff:
             inv_freq = tdiff / cdiff
         step_pos = jmsg['start_mcu_position']
-        for interval, raw_count, add in jmsg['data']:
+        for interval, raw_count, add in data:
             qs_dist = 1
             count = raw_count
             if count < 0:
@@ -364,7 +445,7 @@ class HandleADXL345:
                 jmsg = self.jdispatch.pull_msg(req_time, self.name)
                 if jmsg is None:
                     return 0.
-                self.cur_data = jmsg['data']
+                self.cur_data = get_data_rows(jmsg)
                 self.data_pos = 0
                 continue
             self.last_accel = self.next_accel
@@ -406,20 +487,113 @@ class JsonLogReader:
             parts = data.split(b'\x03')
             parts[0] = msgs[0] + parts[0]
             self.msgs = msgs = parts
+    def add_subscription(self, subscription_id):
+        pass
+
+# A chunked log (as produced by convert_log.py) contains a header
+# followed by a series of zlib compressed blocks and an index.  The
+# messages are grouped into chunks covering a short period of time and
+# each chunk has a separate block per subscription.  A block holds the
+# (json encoded) message parameters and the packed binary rows of all
+# the messages' "data" fields.  Periodically a chunk also stores the
+# full printer status at its start time so that seeking does not
+# require reading the whole log.
+CHUNK_LOG_EXT = ".mlog"
+CHUNK_LOG_MAGIC = b"KMOTAN01"
+CHUNK_LOG_HEADER = struct.Struct('<8sQ') # magic, index position
+CHUNK_BLOCK_HEADER = struct.Struct('<I') # length of json parameters
+
+def decode_chunk_block(qid, data):
+    # Return the messages stored in a chunk block
+    meta_size, = CHUNK_BLOCK_HEADER.unpack_from(data)
+    pos = CHUNK_BLOCK_HEADER.size + meta_size
+    msgs = json.loads(data[CHUNK_BLOCK_HEADER.size:pos].decode())
+    for params in msgs:
+        rows = params.pop('rows', None)
+        if rows is not None:
+            size = struct.calcsize(params['data_format']) * rows
+            params['data'] = data[pos:pos + size]
+            pos += size
+    return [{'q': qid, 'params': params} for params in msgs]
+
+# Read messages from a chunked log
+class ChunkLogReader:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        magic, index_pos = CHUNK_LOG_HEADER.unpack(
+            self.file.read(CHUNK_LOG_HEADER.size))
+        if magic != CHUNK_LOG_MAGIC:
+            raise error("File '%s' is not a chunked log" % (filename,))
+        self.file.seek(index_pos)
+        index = json.loads(zlib.decompress(self.file.read()).decode())
+        self.initial = index['initial']
+        self.chunks = index['chunks']
+        self.chunk_times = [c['time'] for c in self.chunks]
+        self.chunk_pos = 0
+        self.subscriptions = {'status': True}
+        self.msgs = []
+    def get_initial(self):
+        return self.initial
+    def add_subscription(self, subscription_id):
+        self.subscriptions[subscription_id] = True
+    def _read_block(self, location):
+        pos, size = location
+        self.file.seek(pos)
+        return zlib.decompress(self.file.read(size))
+    def _get_status(self, chunk_pos):
+        # Return the full printer status at the start of a chunk
+        kf_pos = chunk_pos
+        while 'keyframe' not in self.chunks[kf_pos]:
+            kf_pos -= 1
+        chunk = self.chunks[kf_pos]
+        status = json.loads(self._read_block(chunk['keyframe']).decode())
+        for chunk in self.chunks[kf_pos:chunk_pos]:
+            location = chunk['blocks'].get('status')
+            if location is None:
+                continue
+            for msg in decode_chunk_block('status', self._read_block(location)):
+                for k, v in msg['params'].get('status', {}).items():
+                    status.setdefault(k, {}).update(v)
+        return status
+    def seek_time(self, req_time):
+        # Position the reader at the last chunk starting before
+        # req_time and return the printer status at that point
+        chunk_pos = max(bisect.bisect_right(self.chunk_times, req_time) - 1, 0)
+        self.chunk_pos = chunk_pos
+        self.msgs = []
+        if not self.chunks:
+            return self.initial['status']
+        return self._get_status(chunk_pos)
+    def pull_msg(self):
+        while not self.msgs:
+            if self.chunk_pos >= len(self.chunks):
+                return None
+            blocks = self.chunks[self.chunk_pos]['blocks']
+            self.chunk_pos += 1
+            # Only decode subscribed data (status updates last)
+            msgs = []
+            for qid in sorted(blocks.keys(), key=lambda q: q == 'status'):
+                if qid in self.subscriptions:
+                    msgs.extend(decode_chunk_block(
+                        qid, self._read_block(blocks[qid])))
+            msgs.reverse()
+            self.msgs = msgs
+        return self.msgs.pop()
 
 # Store messages in per-subscription queues until handlers are ready for them
 class JsonDispatcher:
-    def __init__(self, log_prefix):
+    def __init__(self, log_reader):
         self.names = {}
         self.queues = {}
         self.last_read_time = 0.
-        self.log_reader = JsonLogReader(log_prefix + ".json.gz")
+        self.log_reader = log_reader
         self.is_eof = False
     def check_end_of_data(self):
         return self.is_eof and not any(self.queues.values())
     def add_handler(self, name, subscription_id):
         self.names[name] = q = []
         self.queues.setdefault(subscription_id, []).append(q)
+        self.log_reader.add_subscription(subscription_id)
     def pull_msg(self, req_time, name):
         q = self.names[name]
         while 1:
@@ -501,8 +675,16 @@ def list_datasets():
 class LogManager:
     error = error
     def __init__(self, log_prefix):
-        self.index_reader = JsonLogReader(log_prefix + ".index.gz")
-        self.jdispatch = JsonDispatcher(log_prefix)
+        self.log_prefix = log_prefix
+        self.seek_request = 0.
+        self.chunk_reader = self.index_reader = None
+        if os.path.exists(log_prefix + CHUNK_LOG_EXT):
+            self.chunk_reader = ChunkLogReader(log_prefix + CHUNK_LOG_EXT)
+            self.jdispatch = JsonDispatcher(self.chunk_reader)
+        else:
+            self.index_reader = JsonLogReader(log_prefix + ".index.gz")
+            self.jdispatch = JsonDispatcher(
+                JsonLogReader(log_prefix + ".json.gz"))
         self.initial_start_time = self.start_time = 0.
         self.datasets = {}
         self.initial_status = {}
@@ -510,7 +692,10 @@ class LogManager:
         self.log_subscriptions = {}
         self.status_tracker = None
     def setup_index(self):
-        fmsg = self.index_reader.pull_msg()
+        if self.chunk_reader is not None:
+            fmsg = self.chunk_reader.get_initial()
+        else:
+            fmsg = self.index_reader.pull_msg()
         self.initial_status = status = fmsg['status']
         self.start_status = dict(status)
         start_time = status['toolhead']['estimated_print_time']
@@ -522,10 +707,18 @@ class LogManager:
         return {name: None for name in LogHandlers}
     def get_jdispatch(self):
         return self.jdispatch
+    def get_log_position(self):
+        # Return the information needed to open the log at the same
+        # position (eg, from another process)
+        return self.log_prefix, self.seek_request
     def seek_time(self, req_time):
+        self.seek_request = req_time
         self.start_time = req_start_time = self.initial_start_time + req_time
         start_status = self.start_status
         seek_time = max(self.initial_start_time, req_start_time - 1.)
+        if self.chunk_reader is not None:
+            self.start_status = self.chunk_reader.seek_time(seek_time)
+            return
         file_position = 0
         while 1:
             fmsg = self.index_reader.pull_msg()
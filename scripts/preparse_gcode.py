@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# Create pre-parsed versions of g-code files for virtual_sdcard
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+preparsed_gcode = importlib.import_module('.preparsed_gcode', 'extras')
+
+def main():
+    usage = "%prog [options] <gcode files>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-o", "--output", type="string", dest="output",
+                    default=None, help="filename of pre-parsed output")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    if options.output is not None and len(args) != 1:
+        opts.error("Only one input file may be used with --output")
+    for fname in args:
+        count = preparsed_gcode.convert(fname, options.output)
+        sys.stdout.write("%s: %d commands\n" % (fname, count))
+
+if __name__ == '__main__':
+    main()